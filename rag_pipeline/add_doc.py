@@ -3,20 +3,22 @@
 # For legal documents (found on adilet.kz) MISTRAL OCT is used. It is required to set up Mistral API key, which allows a free parsing within limits 
 # To get API-key: https://console.mistral.ai/api-keys
 
-from mistral import Mistral 
+from __future__ import annotations
+
 import argparse
 from pathlib import Path
-from langchain.vectorstores import FAISS
-from langchain.embeddings import OpenAIEmbeddings
-import json
+import numpy as np
+import asyncio
+import io
 import re
-import pymupdf
-from mistralai import DocumentURLChunk, ImageURLChunk, TextChunk
-from mistralai.models import OCRResponse
-from langchain.schema import Document
-from typing import List
+from typing import List, Optional
 import os
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 from langchain_text_splitters.character import RecursiveCharacterTextSplitter
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 """
 ОБЯЗАТЕЛЬНЫЕ ПАРАМЕТРЫ СКРИПТА:
@@ -27,26 +29,32 @@ from langchain_text_splitters.character import RecursiveCharacterTextSplitter
 - output — название JSON файла для сохранения сырого результата распознанного текста. В противном случае он не будет сохранен 
 - mistral_api_key — API ключ от MISTRAL (взять из https://console.mistral.ai/api-keys), с лимитом, но бесплатно
 - vectorstore — путь до папки с векторной базой для RAG. Если задан, то новые документы добавляются в существующую базу
+- index_type — тип индекса при создании новой базы: "flat" (по умолчанию, точный поиск), "hnsw" (граф HNSW,
+  поиск за ~log(N) — для баз от 10 тыс. чанков), "ivf" (IVFFlat, обучается на первых 10 тыс. чанках документа)
+- keep_images — запросить картинки в base64 у Mistral OCR (нужно только для сохранения в output; по умолчанию не запрашиваются)
 """
-# парсинг аргументов
-parser = argparse.ArgumentParser(description="Document Parsing Script")
-# обязательные
-parser.add_argument("pdf_path", help="Путь к PDF файлу")
-parser.add_argument('model_type', choices=['mistral', 'other'],
-                    help='Тип модели: "mistral" для приказов с zan.kz (см. образец в data/raw), "other" для остальных документов'
+# regex компилируются один раз при импорте, а не на каждую секцию/чанк
+# разбивка текста на главы, параграфы и приложения
+_SPLIT_RE = re.compile(r'(?=(?:\d+[-\s]*(?:тарау|параграф|приложение|қосымша)|(?:тарау|параграф|қосымша|Глава|Параграф|Приложение)[-\s]*\d+|#\s*Приложение\s+\d+))')
+# начало секции с заголовком главы, параграфа или приложения (каз./рус.) — одна альтернатива вместо 10 проверок
+_META_RE = re.compile(
+    r'\d+[-\s]*(?:тарау|параграф|қосымша|приложение)'
+    r'|(?:тарау|параграф|қосымша|Глава)[-\s]*\d+'
+    r'|#\s*Приложение\s+\d+',
+    re.IGNORECASE
 )
-parser.add_argument('openai_api_key', help="OpenAI api key для эмбеддингов")
-# дополнительные
-parser.add_argument("--output", help="Имя JSON-файла для сохранения распознанного текста")
-parser.add_argument("--mistral_api_key", help="Mistral API key, если mode=mistral")
-parser.add_argument("--vectorstore", help="Папка с расположением базы данных FAISS (для векторного поиска)")
-
-args = parser.parse_args()
+# чанки, состоящие только из разделителя — одна альтернатива вместо 10 отдельных проверок
+_SEP_RE = re.compile(
+    r'Глава\s+\d+|Параграф\s+\d+|\d+-тарау|\d+-параграф|\d+-қосымша'
+    r'|тарау\s+\d+|параграф\s+\d+|қосымша\s+\d+|#\s*Приложение\s+\d+|\d+-приложение',
+    re.IGNORECASE
+)
+# размер батча эмбеддингов при добавлении в индекс и кол-во чанков для обучения IVF
+INSERT_BATCH_SIZE = 4096
+IVF_TRAIN_SIZE = 10000
 
-os.environ["OPENAI_API_KEY"] = args.openai_api_key
-# проверка есть ли PDF
-pdf_file = Path(args.pdf_path)
-assert pdf_file.is_file()
+# ссылки на картинки в markdown от Mistral OCR
+_IMG_RE = re.compile(r'!\[img-\d+\.jpeg\]\(img-\d+\.jpeg\)')
 
 # дополнительные функции для обработки текста
 def split_kazakh_russian_text(text: str) -> List[Document]:
@@ -60,12 +68,11 @@ def split_kazakh_russian_text(text: str) -> List[Document]:
         List[Document]: лист объектов LangChain Document для дальнейшего заполнения базы
     """
     
-    documents = []
+    from langchain.schema import Document
 
-    # regex для разбивки 
-    split_pattern = r'(?=(?:\d+[-\s]*(?:тарау|параграф|приложение|қосымша)|(?:тарау|параграф|қосымша|Глава|Параграф|Приложение)[-\s]*\d+|#\s*Приложение\s+\d+))'
+    documents = []
 
-    sections = re.split(split_pattern, text)
+    sections = _SPLIT_RE.split(text)
     
     for idx, section in enumerate(sections):
         if not section.strip():
@@ -75,30 +82,9 @@ def split_kazakh_russian_text(text: str) -> List[Document]:
         metadata = {
         }
         
-        patterns_metadata = [
-            (r'(\d+)[-\s]*тарау', 'chapter', 'kk'),
-            (r'(\d+)[-\s]*параграф', 'paragraph', 'kk'), 
-            (r'(\d+)[-\s]*қосымша', 'appendix', 'kk'),
-            (r'тарау[-\s]*(\d+)', 'chapter', 'kk'),
-            (r'параграф[-\s]*(\d+)', 'paragraph', 'ru'),
-            (r'қосымша[-\s]*(\d+)', 'appendix', 'ru'),
-            (r'Глава[-\s]*(\d+)', 'chapter', 'ru'),
-            (r'Параграф[-\s]*(\d+)', 'paragraph', 'ru'),
-            (r'(\d+)[-\s]*приложение', 'appendix', 'ru'),
-            (r'#\s*Приложение\s+(\d+)', 'appendix', 'ru'),
-        ]
-        
-        matched = False
-        for pattern, content_type, language in patterns_metadata:
-            match = re.match(pattern, content, re.IGNORECASE)
-            if match:
-                metadata.update({
-                'source': args.pdf_path,
-                })
-                matched = True
-                break
-        
-        if not matched:
+        if _META_RE.match(content):
+            metadata['source'] = args.pdf_path
+        else:
             metadata['content_type'] = 'content'
         
         doc = Document(
@@ -111,100 +97,241 @@ def split_kazakh_russian_text(text: str) -> List[Document]:
 
 def is_separator_only(chunk: str) -> bool:
         """Проверка на наличие одного из разделителей текста"""
-        separator_patterns = [
-            r'^Глава\s+\d+$',
-            r'^Параграф\s+\d+$',
-            r'^\d+-тарау$',
-            r'^\d+-параграф$',
-            r'^\d+-қосымша$',
-            r'^тарау\s+\d+$',
-            r'^параграф\s+\d+$',
-            r'^қосымша\s+\d+$',
-            r'^#\s*Приложение\s+\d+$',
-            r'^\d+-приложение$',
-        ]
-        
-        for pattern in separator_patterns:
-            if re.match(pattern, chunk.strip(), re.IGNORECASE):
-                return True
-        return False
-
-# если был указан mistral_api_key — для парсинга файла используется Mistral OCR
-if args.mistral_api_key is not None and args.model_type=="mistral":
-    client = Mistral(api_key=args.mistral_api_key)
-    uploaded_file = client.files.upload(
+        return _SEP_RE.fullmatch(chunk.strip()) is not None
+
+# Временные ошибки Mistral API, после которых запрос повторяется
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_backoff = wait_exponential_jitter(initial=1, max=60)
+
+def _is_retryable(e: BaseException) -> bool:
+    return isinstance(e, httpx.TransportError) or getattr(e, "status_code", None) in _RETRY_STATUS
+
+def _retry_wait(retry_state) -> float:
+    """Задержка из заголовка Retry-After, если сервер его прислал, иначе экспоненциальная с jitter"""
+    response = getattr(retry_state.outcome.exception(), "raw_response", None)
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return min(float(retry_after), 60)
+    return _backoff(retry_state)
+
+@retry(stop=stop_after_attempt(6), wait=_retry_wait, retry=retry_if_exception(_is_retryable), reraise=True)
+async def _mistral_call(method, **kwargs):
+    """Вызов async-метода клиента Mistral с повторами при временных ошибках (остальные ошибки — сразу)"""
+    return await method(**kwargs)
+
+async def ocr_pdf(client: Mistral, pdf_file: Path, keep_images: bool):
+    """Mistral OCR: загрузка файла, подписанная ссылка и распознавание"""
+    uploaded_file = await _mistral_call(
+        client.files.upload_async,
         file = {"file_name": pdf_file.stem, "content": pdf_file.read_bytes()},
         purpose="ocr"
     )
-    signed_url = client.files.get_signed_url(file_id=uploaded_file.id, expiry=1)
-    pdf_response = client.ocr.process(
+    signed_url = await _mistral_call(client.files.get_signed_url_async, file_id=uploaded_file.id, expiry=1)
+    return await _mistral_call(
+        client.ocr.process_async,
         document=DocumentURLChunk(document_url=signed_url.url),
         model="mistral-ocr-latest",
-        include_image_base64=True
-        )
-    response_dict = json.loads(pdf_response.model_dump_json())
-    if args.output is not None:
-        with open(args.output, 'w') as f:
-            json.dump(response_dict, f)
-    
-    # сборка и предобработка текста 
-    full_text = " ".join(i['markdown'] for i in response_dict['pages'])
-    pattern = r'!\[img-\d+\.jpeg\]\(img-\d+\.jpeg\)'
-    langchain_docs = split_kazakh_russian_text(re.sub(pattern, '', full_text))
-
-    # очистка листа от документов, где только текст сепараторов
-    new_doc = []
-    for doc in langchain_docs:
-        if is_separator_only(doc.page_content) or doc.page_content=="#":
-            continue
-        else:
-            new_doc.append(doc)
-elif args.mistral_api_key is None and args.model_type=="mistral":
-    raise ValueError("Provide Mistral API key!")
-else:
-    # pymupdf, если не MISTRAL OCR
-    langchain_docs = []
-    pdf_doc = pymupdf.open(pdf_file)
-    for page_num in range(pdf_doc.page_count):
-        page = pdf_doc[page_num]
-        text = page.get_text()
-        if text.strip():
-                # создание LangChain Document
-                doc = Document(
-                    page_content=text,
-                    metadata={
-                        "source": args.pdf_path,
-                    }
-                )
-                langchain_docs.append(doc)
-    pdf_doc.close()
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000,
-        chunk_overlap=100,
+        # картинки из текста удаляются, поэтому base64 запрашивается только для сохранения в --output
+        include_image_base64=keep_images
+    )
+
+def load_vectorstore(path: Optional[str], embeddings) -> Optional[FAISS]:
+    """Существующая база FAISS или None, если путь не задан или базы еще нет"""
+    if path is None or not Path(path).exists():
+        return None
+    db = FAISS.load_local(path, embeddings=embeddings)
+    if db.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        # база по скалярному произведению — новые векторы тоже нормализуются
+        db.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+        db._normalize_L2 = True
+    return db
+
+async def ocr_and_load(client: Mistral, pdf_file: Path, keep_images: bool, vectorstore_path: Optional[str], embeddings):
+    """Пока Mistral распознает документ, существующая база FAISS читается с диска в отдельном потоке"""
+    return await asyncio.gather(
+        ocr_pdf(client, pdf_file, keep_images),
+        asyncio.to_thread(load_vectorstore, vectorstore_path, embeddings)
     )
-    new_doc = []
-    for doc in langchain_docs:
-        chunks = text_splitter.split_text(doc.page_content)
-        for i, chunk in enumerate(chunks):
-            chunked_doc = Document(
-                page_content=chunk,
-                metadata={
-                    **doc.metadata,
-                    "chunk": i + 1,
-                    "total_chunks_on_page": len(chunks)
-                }
-            )
-            new_doc.append(chunked_doc)
-
-if args.vectorstore is not None and Path(args.vectorstore).exists():
-    # Создание новой базы данных и добавление документов батчами
-    db = FAISS.load_local(args.vectorstore, embeddings=OpenAIEmbeddings(model="text-embedding-3-large"))
-    for i in range(0, len(new_doc), 10):
-        batch_docs = new_doc[i:min(i + 10, len(new_doc))]
-        db.add_documents(batch_docs)
-    db.save_local(args.vectorstore)
-else:
-    # создание новой базы
-    db = FAISS.from_documents(new_doc, embeddings=OpenAIEmbeddings(model="text-embedding-3-large"))
+
+def build_index(index_type: str, vectors: np.ndarray) -> faiss.Index:
+    """Пустой индекс по скалярному произведению для нормализованных векторов (IVF обучается на vectors — выборке векторов)"""
+    d = vectors.shape[1]
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+        return index
+    if index_type == "ivf":
+        # faiss нужно не меньше 39 векторов на кластер для обучения k-means
+        max_nlist = len(vectors) // 39
+        if max_nlist < 1:
+            warnings.warn(f"Too few vectors for IVF ({len(vectors)}), building flat index instead")
+            return faiss.IndexFlatIP(d)
+        nlist = min(max(1, int(4 * np.sqrt(len(vectors)))), max_nlist)
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, nlist, faiss.METRIC_INNER_PRODUCT)
+        train_vectors = vectors.copy()
+        faiss.normalize_L2(train_vectors)
+        index.train(train_vectors)
+        return index
+    return faiss.IndexFlatIP(d)
+
+# PDF, открытый в процессе извлечения страниц (один раз на процесс, а не на каждую страницу)
+_worker_pdf = None
+
+def _open_worker_pdf(pdf_path: str):
+    """initializer процесса: открыть PDF и разобрать его xref один раз"""
+    global _worker_pdf
+    import pymupdf
+    _worker_pdf = pymupdf.open(pdf_path)
+
+def _extract_page(page_num: int) -> str:
+    """Текст одной страницы PDF (выполняется в отдельном процессе: объекты Page не передаются между процессами)"""
+    import pymupdf
+    # простой текст без сортировки блоков и доп. обработки (лигатуры, пробелы) — текст все равно режется на чанки
+    return _worker_pdf[page_num].get_text("text", sort=False, flags=pymupdf.TEXT_MEDIABOX_CLIP)
+
+if __name__ == "__main__":
+    # парсинг аргументов
+    parser = argparse.ArgumentParser(description="Document Parsing Script")
+    # обязательные
+    parser.add_argument("pdf_path", help="Путь к PDF файлу")
+    parser.add_argument('model_type', choices=['mistral', 'other'],
+                        help='Тип модели: "mistral" для приказов с zan.kz (см. образец в data/raw), "other" для остальных документов'
+    )
+    parser.add_argument('openai_api_key', help="OpenAI api key для эмбеддингов")
+    # дополнительные
+    parser.add_argument("--output", help="Имя JSON-файла для сохранения распознанного текста")
+    parser.add_argument("--mistral_api_key", help="Mistral API key, если mode=mistral")
+    parser.add_argument("--vectorstore", help="Папка с расположением базы данных FAISS (для векторного поиска)")
+    parser.add_argument("--index_type", choices=["flat", "hnsw", "ivf"], default="flat",
+                        help="Тип индекса новой базы: flat (точный поиск), hnsw (граф, для 10 тыс.+ чанков), ivf (кластеры)")
+    parser.add_argument("--keep_images", action="store_true", help="Запросить у Mistral OCR картинки в base64 (сохраняются в --output)")
+
+    args = parser.parse_args()
+
+    os.environ["OPENAI_API_KEY"] = args.openai_api_key
+    # проверка есть ли PDF
+    pdf_file = Path(args.pdf_path)
+    # явная проверка (assert отключается при python -O) — до запросов к OCR и OpenAI
+    if not pdf_file.is_file():
+        parser.error(f"PDF not found: {pdf_file}")
+    if pdf_file.stat().st_size == 0:
+        parser.error(f"PDF is empty: {pdf_file}")
+
+    # тяжелые библиотеки (langchain, faiss) импортируются только после проверки аргументов;
+    # процессы извлечения страниц их не загружают
+    import faiss
+    from langchain.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain.embeddings import OpenAIEmbeddings
+
+    # один клиент эмбеддингов (и пул HTTP-соединений) на все запросы скрипта
+    embeddings = OpenAIEmbeddings(model="text-embedding-3-large", chunk_size=512)
+
+    # если был указан mistral_api_key — для парсинга файла используется Mistral OCR
+    if args.mistral_api_key is not None and args.model_type=="mistral":
+        from mistralai import Mistral, DocumentURLChunk
+        client = Mistral(api_key=args.mistral_api_key)
+        pdf_response, db = asyncio.run(
+            ocr_and_load(client, pdf_file, args.keep_images, args.vectorstore, embeddings)
+        )
+        # модель pydantic -> dict напрямую, без сериализации в JSON и обратного разбора
+        response_dict = pdf_response.model_dump()
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(pdf_response.model_dump_json())
+
+        # сборка и предобработка текста 
+        # страницы пишутся в один растущий буфер, ссылки на картинки удаляются сразу по каждой странице
+        full_text = io.StringIO()
+        for page in response_dict['pages']:
+            markdown = page['markdown']
+            # ссылки удаляются через str.replace по id картинок страницы; regex — только если в тексте остались другие
+            for image in page.get('images') or ():
+                markdown = markdown.replace(f"![{image['id']}]({image['id']})", '')
+            if '![img-' in markdown:
+                markdown = _IMG_RE.sub('', markdown)
+            full_text.write(markdown)
+            full_text.write(' ')
+        langchain_docs = split_kazakh_russian_text(full_text.getvalue())
+
+        # очистка листа от документов, где только текст сепараторов
+        texts, metadatas = [], []
+        for doc in langchain_docs:
+            if is_separator_only(doc.page_content) or doc.page_content=="#":
+                continue
+            texts.append(doc.page_content)
+            metadatas.append(doc.metadata)
+    elif args.mistral_api_key is None and args.model_type=="mistral":
+        raise ValueError("Provide Mistral API key!")
+    else:
+        # pymupdf, если не MISTRAL OCR
+        import pymupdf
+        db = load_vectorstore(args.vectorstore, embeddings)
+        with pymupdf.open(pdf_file) as pdf_doc:
+            page_count = pdf_doc.page_count
+        # Извлечение текста страниц параллельно в нескольких процессах: свободный процесс берет следующую страницу,
+        # а в очереди не больше max_pending задач, чтобы большой PDF не ставился в очередь целиком
+        workers = min(os.cpu_count() or 1, 4)
+        max_pending = workers * 8
+        page_texts = [""] * page_count
+        pages = iter(range(page_count))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_worker_pdf,
+                                 initargs=(str(pdf_file),)) as executor:
+            pending = {executor.submit(_extract_page, i): i for i in islice(pages, max_pending)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page_texts[pending.pop(future)] = future.result()
+                    next_page = next(pages, None)
+                    if next_page is not None:
+                        pending[executor.submit(_extract_page, next_page)] = next_page
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=2000,
+            chunk_overlap=100,
+        )
+        # тексты чанков и метаданные собираются сразу, без промежуточных LangChain Document
+        texts, metadatas = [], []
+        for page_num, text in enumerate(page_texts, start=1):
+            if not text.strip():
+                continue
+            chunks = text_splitter.split_text(text)
+            for i, chunk in enumerate(chunks, start=1):
+                texts.append(chunk)
+                metadatas.append({
+                    "source": args.pdf_path,
+                    "page": page_num,
+                    "chunk": i,
+                    "total_chunks_on_page": len(chunks),
+                })
+
+    # эмбеддинги считаются и добавляются в индекс батчами — в памяти не больше одного батча векторов
+    # (OpenAIEmbeddings внутри батча сам отправляет тексты по chunk_size)
+    def embed(start: int, stop: int) -> np.ndarray:
+        return np.asarray(embeddings.embed_documents(texts[start:stop]), dtype=np.float32)
+
+    start = 0
+    if db is None:
+        # создание новой базы: нормализованные векторы, индекс по скалярному произведению (= косинусная близость);
+        # IVF обучается на первых IVF_TRAIN_SIZE чанках, эти же векторы сразу добавляются в базу
+        first_size = IVF_TRAIN_SIZE if args.index_type == "ivf" else INSERT_BATCH_SIZE
+        vectors = embed(0, first_size)
+        db = FAISS(
+            embedding_function=embeddings,
+            index=build_index(args.index_type, vectors),
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            normalize_L2=True
+        )
+        db.add_embeddings(zip(texts[:first_size], vectors), metadatas=metadatas[:first_size])
+        start = first_size
+
+    # остальные чанки (или все — при добавлении в существующую базу)
+    for batch_start in range(start, len(texts), INSERT_BATCH_SIZE):
+        batch_stop = batch_start + INSERT_BATCH_SIZE
+        vectors = embed(batch_start, batch_stop)
+        db.add_embeddings(zip(texts[batch_start:batch_stop], vectors), metadatas=metadatas[batch_start:batch_stop])
+
     save_path = args.vectorstore if args.vectorstore else "faiss_vectorstore"
-    db.save_local(save_path)
\ No newline at end of file
+    db.save_local(save_path)
@@ -1,24 +1,58 @@
 import json
+import orjson
 import os
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from pathlib import Path
 import mimetypes
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import faiss
 import re
 import time
-from openai import OpenAI
+import threading
+from collections import Counter, deque
+from cachetools import LRUCache
+from openai import OpenAI, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from langchain_core.output_parsers import StrOutputParser
 from langchain.callbacks.manager import get_openai_callback
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_community.vectorstores import FAISS
 from langchain.memory import ConversationBufferMemory
 from datetime import datetime
 
 from src.rag_chatbot.core.llm import llm
+from src.rag_chatbot.core.http_clients import http_client
 from src.rag_chatbot.utils.logger import logger
 from rag_pipeline.prompts import chatbot_prompt, query_generation_prompt
+from rag_pipeline.rrf import rrf_fuse
+from rag_pipeline.vectorstore import load_vectorstore
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """float32 матрица с единичными строками: косинусная близость = скалярное произведение"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim != 2:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+# Слова названий документов и запросов (разделители — пробелы, "_", "-" и т.п.): короткие служебные слова ("о", "и", "по") не учитываются, числа — да
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+def _document_tokens(text: str) -> set:
+    return {token for token in _TOKEN_RE.findall(text.lower()) if len(token) > 2 or token.isdigit()}
+
+# "_" и "-" в названиях документов заменяются пробелами для текста эмбеддинга
+_NAME_SEP_RE = re.compile(r'[_\-]')
+
+# С какого кол-ва документов индекс названий строится как IVF-PQ вместо точного (fp16) индекса
+DOCUMENT_IVF_MIN_SIZE = 5000
+
+# Кол-во названий документов в одном запросе к OpenAI embeddings
+EMBEDDING_BATCH_SIZE = 512
+
+# Один сгенерированный запрос на непустую строку, без маркеров списка "1." / "2)" / "-"
+_QUERY_RE = re.compile(r"^\s*(?:(?:\d+[.)]|[-*•])\s+)?(.+?)\s*$", re.M)
 
 
 class UnifiedRAGAgent:
@@ -38,17 +72,24 @@ class UnifiedRAGAgent:
                  openai_embedding_model: str = "text-embedding-3-small",
                  openai_api_key: Optional[str] = None,
                  memory_window_size: int = 10,
-                 document_embeddings_path: Optional[str] = "document_embeddings.npy"):
+                 document_embeddings_path: Optional[str] = "document_embeddings.npy",
+                 search_batcher=None,
+                 vectorstore: Optional[FAISS] = None):
         """
        Инициализация агентов
         Args:
             local_index_path: путь к векторной базе FAISS
-            embedding_model: эмбеддинги базы 
+            embedding_model: эмбеддинги базы — та же модель, которой построен индекс. Для индекса по скалярному
+                произведению (IndexFlatIP, IVF-PQ с METRIC_INNER_PRODUCT) векторы базы нормализованы при построении,
+                а запросы нормализуются при поиске (rag_pipeline/vectorstore.py)
             documents_json_path: путь до JSON с названиями и адресами документов
             llm_params: параметры LLM
             openai_embedding_model: OpenAI embedding model для поиска докуметов
             openai_api_key: OpenAI API key
             memory_window_size: окно разговора для добавления в контекст
+            search_batcher: общий SearchBatcher для объединения поисков FAISS из параллельных запросов
+            vectorstore: уже загруженная база FAISS (общая, только для чтения); если не задана — грузится из local_index_path
+                в фоновом потоке при создании агента и переиспользуется
         """
         self.document_embeddings_path = document_embeddings_path
         self.local_index_path = local_index_path
@@ -56,11 +97,26 @@ class UnifiedRAGAgent:
         self.documents_json_path = documents_json_path
         self.openai_embedding_model = openai_embedding_model
         self.memory_window_size = memory_window_size
+        self.search_batcher = search_batcher
+        self.vectorstore = vectorstore
+        self._vectorstore_lock = threading.Lock()
+        # Сгенерированные запросы по (запрос, n, контекст) — повторный вопрос не идет в LLM
+        self._generated_queries: LRUCache = LRUCache(maxsize=5000)
+        self._generated_queries_lock = threading.Lock()
+        # Эмбеддинги запросов для поиска документов — частые запросы ("скачать документ") не идут в OpenAI
+        self._query_embeddings: LRUCache = LRUCache(maxsize=1024)
+        self._query_embeddings_lock = threading.Lock()
+        # id документов FAISS по (база, k, запрос) — повторный запрос не идет ни в OpenAI, ни в индекс
+        self._retrieval_cache: LRUCache = LRUCache(maxsize=512)
+        self._retrieval_cache_lock = threading.Lock()
         
         self.llm = llm
+        # Цепочки LCEL собираются один раз и переиспользуются всеми запросами
+        self._query_chain = query_generation_prompt | self.llm | StrOutputParser()
+        self._answer_chain = chatbot_prompt | self.llm | StrOutputParser()
         # for embeddings: since the FAISS base is using OpenAI embeddings, it's necessary to have this one. 
         # In case you want to use other embeddings—REBUILD vector index
-        self.openai_client = OpenAI(api_key=openai_api_key) if openai_api_key else OpenAI()
+        self.openai_client = OpenAI(api_key=openai_api_key, http_client=http_client) if openai_api_key else OpenAI(http_client=http_client)
         
         # Инициализация памяти
         self.memory = ConversationBufferMemory(
@@ -68,10 +124,21 @@ class UnifiedRAGAgent:
             return_messages=True,
             output_key="answer"
         )
-        self.conversation_history = []
+        # Последние memory_window_size обменов: старые вытесняются при добавлении, без копирования списка
+        self.conversation_history = deque(maxlen=memory_window_size)
+        # Отформатированный контекст собирается один раз при обновлении памяти, а не на каждый вызов
+        self._conversation_context = "No previous conversation."
+        # Запросы выполняются параллельно в пуле потоков с одним общим агентом — состояние разговора под lock
+        self._memory_lock = threading.Lock()
         
         self.document_mappings = self._load_document_mappings()
+        self.refresh_documents()
+        if self.vectorstore is None:
+            # База FAISS грузится в фоне, пока строится индекс документов (запросы к OpenAI) и идут первые вызовы LLM;
+            # _get_vectorstore дождется загрузки под тем же lock
+            threading.Thread(target=self._get_vectorstore, name="faiss-load", daemon=True).start()
         self._load_or_build_semantic_index()
+        self._build_document_index()
         
         # Объявление всех инструментов LLM. Для добавления новый инструментов—добавлять сюда. 
         self.function_definitions = [
@@ -116,8 +183,8 @@ class UnifiedRAGAgent:
             }
         ]
         
-        self.decision_prompt = ChatPromptTemplate.from_messages([
-            ("system", f"""You are Zaure (Зауре) — a professional AI legal assistant created by the company Orleu. You help users with questions about regulatory documents in education, especially concerning аттестация педагогов, квалификационные категории, and ОЗП (Педагогтердің білімін бағалау).
+        # Неизменная часть промпта решений — готовое сообщение: без разбора шаблона LangChain на каждый вызов
+        self._decision_system = SystemMessage(content=f"""You are Zaure (Зауре) — a professional AI legal assistant created by the company Orleu. You help users with questions about regulatory documents in education, especially concerning аттестация педагогов, квалификационные категории, and ОЗП (Педагогтердің білімін бағалау).
 
 Available capabilities:
 1. **Document Retrieval** — when the user explicitly asks for a document, PDF, manual, guide, or mentions "download".
@@ -139,89 +206,201 @@ Additionally:
 - In Kazakh queries, translate mentions of "ОЗП" to "ПББ" in your answers.
 - Maintain a professional, formal tone.
 
-Conversation context so far:
-{{chat_context}}
+Analyze the user query, taking into account the conversation context given below, and decide whether to retrieve a document, search the knowledge base, answer directly, or politely redirect.""")
+        # Модель с объявленными инструментами создается один раз
+        self._decision_llm = self.llm.bind(
+            functions=self.function_definitions,
+            function_call="auto"
+        )
 
-Now analyze the user query and decide whether to retrieve a document, search the knowledge base, answer directly, or politely redirect."""),
-            ("user", "{user_query}")
-        ])
+    def _document_names_path(self) -> str:
+        """JSON с названиями документов рядом с матрицей эмбеддингов"""
+        return str(Path(self.document_embeddings_path).with_suffix(".json"))
 
     def _save_document_embeddings(self):
-        """Сохранение базы данных документов (эмбеддингов)"""
+        """Сохранение базы данных документов: матрица float16 (.npy) и названия (.json)"""
         try:
-            data = {
-                "document_names": self.document_names,
-                "document_embeddings": self.document_embeddings
-            }
-            os.makedirs(os.path.dirname(self.document_embeddings_path), exist_ok=True)
-            np.save(self.document_embeddings_path, data)
+            os.makedirs(os.path.dirname(self.document_embeddings_path) or ".", exist_ok=True)
+            # float16 — вдвое меньше на диске и в памяти; для сравнения названий документов точности достаточно
+            np.save(self.document_embeddings_path, np.asarray(self.document_embeddings, dtype=np.float16))
+            with open(self._document_names_path(), "w", encoding="utf-8") as f:
+                json.dump(self.document_names, f, ensure_ascii=False)
+            # Обученный индекс по старым эмбеддингам больше не подходит — будет построен заново
+            if os.path.exists(self._document_index_path()):
+                os.remove(self._document_index_path())
             logger.info(f"Saved document embeddings to {self.document_embeddings_path}")
         except Exception as e:
             logger.error(f"Failed to save document embeddings: {e}")
 
     def _load_or_build_semantic_index(self):
         """Подгрузить базу данных документов, если её нет—создать и сохранить """
-        if os.path.exists(self.document_embeddings_path):
+        names_path = self._document_names_path()
+        if os.path.exists(self.document_embeddings_path) and os.path.exists(names_path):
             try:
                 logger.info(f"Loading cached document embeddings from {self.document_embeddings_path}")
+                # матрица (уже нормализованная) отображается в память без pickle и копирования
+                embeddings = np.load(self.document_embeddings_path, mmap_mode="r")
+                with open(names_path, "rb") as f:
+                    names = orjson.loads(f.read())
+                if len(names) == len(embeddings):
+                    self.document_names = names
+                    self.document_embeddings = embeddings
+                    return
+                logger.error("Cached document embeddings do not match document names, rebuilding")
+            except Exception as e:
+                logger.error(f"Failed to load cached embeddings: {e}")
+        elif os.path.exists(self.document_embeddings_path):
+            # Старый формат (словарь через pickle) переводится в новый один раз, без повторного расчета эмбеддингов
+            try:
+                logger.info(f"Converting legacy document embeddings in {self.document_embeddings_path}")
                 data = np.load(self.document_embeddings_path, allow_pickle=True).item()
-                self.document_names = data["document_names"]
-                self.document_embeddings = data["document_embeddings"]
+                self.document_names = list(data["document_names"])
+                self.document_embeddings = _normalize_rows(data["document_embeddings"])
+                self._save_document_embeddings()
                 return
             except Exception as e:
                 logger.error(f"Failed to load cached embeddings: {e}")
         
         self._build_semantic_index()
-        self._save_document_embeddings()
+        if len(self.document_embeddings) > 0:
+            self._save_document_embeddings()
+
+    def _document_index_path(self) -> str:
+        """Обученный индекс IVF-PQ по названиям документов рядом с матрицей эмбеддингов"""
+        return str(Path(self.document_embeddings_path).with_suffix(".faiss"))
+
+    @staticmethod
+    def _build_faiss_doc_index(vectors: np.ndarray) -> faiss.Index:
+        """Точный поиск для небольших библиотек, IVF-PQ (в ~16 раз меньше памяти, поиск по nprobe кластерам) — для больших"""
+        n, d = vectors.shape
+        if n < DOCUMENT_IVF_MIN_SIZE:
+            # float16 в индексе (как на диске): вдвое меньше памяти, SIMD-декодирование при поиске, обучение не нужно
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.index_factory(d, f"IVF{int(np.sqrt(n))},PQ{d // 4}x8", faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            faiss.extract_index_ivf(index).nprobe = 8
+        index.add(vectors)
+        return index
+
+    def _build_document_index(self):
+        """Индекс FAISS по скалярному произведению над нормализованными эмбеддингами названий (= косинус)"""
+        self.document_index = None
+        n = len(self.document_embeddings)
+        if n == 0:
+            return
+        index_path = self._document_index_path()
+        if n >= DOCUMENT_IVF_MIN_SIZE and os.path.exists(index_path):
+            # IVF-PQ обучается долго — сохраненный индекс переиспользуется, если он для тех же документов
+            try:
+                index = faiss.read_index(index_path)
+                if index.ntotal == n:
+                    faiss.extract_index_ivf(index).nprobe = 8
+                    self.document_index = index
+                    return
+            except RuntimeError as e:
+                logger.error(f"Failed to load document index: {e}")
+        # float16 с диска приводится к float32 один раз — при загрузке, а не на каждый запрос
+        vectors = np.ascontiguousarray(self.document_embeddings, dtype=np.float32)
+        self.document_index = self._build_faiss_doc_index(vectors)
+        if n >= DOCUMENT_IVF_MIN_SIZE:
+            try:
+                faiss.write_index(self.document_index, index_path)
+            except RuntimeError as e:
+                logger.error(f"Failed to save document index: {e}")
 
     def _load_document_mappings(self) -> Dict[str, str]:
         """Подгрузить JSON с информацией о документах"""
         try:
-            with open(self.documents_json_path, 'r', encoding='utf-8') as f:
-                mappings = json.load(f)
+            with open(self.documents_json_path, 'rb') as f:
+                mappings = orjson.loads(f.read())
             logger.info(f"Loaded {len(mappings)} document mappings")
             return mappings
         except FileNotFoundError:
             logger.error(f"Document mappings file not found: {self.documents_json_path}")
             return {}
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Error parsing document mappings JSON: {e}")
             return {}
 
-    def _get_openai_embedding(self, text: str) -> Optional[List[float]]:
-        """Получение эмбеддингов"""
+    def refresh_documents(self):
+        """Пересчитать кэш файлов документов (после добавления или удаления PDF на диске)"""
+        # Названия в нижнем регистре считаются один раз для поиска по точному совпадению
+        self._document_names_lower = [(name.lower(), name, path) for name, path in self.document_mappings.items()]
+        # Размеры существующих файлов: проверка наличия — поиск в словаре, а не системный вызов на каждый запрос
+        self._document_sizes = {}
+        for path in self.document_mappings.values():
+            try:
+                self._document_sizes[path] = os.stat(path).st_size
+            except OSError:
+                pass
+        # Слова названий существующих документов — для совпадения по словам без эмбеддинга.
+        # Слова, которые есть больше чем в четверти названий (общий шаблон "№ 83 Об утверждении Правил ...",
+        # "Приложение", "қосымша"; библиотека на двух языках — шаблон каждого языка в половине названий),
+        # документы не различают и не учитываются
+        documents = [
+            (_document_tokens(name_lower), name, path)
+            for name_lower, name, path in self._document_names_lower
+            if path in self._document_sizes
+        ]
+        document_frequency = Counter(token for tokens, _, _ in documents for token in tokens)
+        common = {token for token, count in document_frequency.items() if count * 4 > len(documents)}
+        self._document_tokens = [(tokens - common, name, path) for tokens, name, path in documents]
+
+    def _get_openai_embedding(self, text: str) -> Optional[np.ndarray]:
+        """Получение эмбеддингов (float32, только для чтения); повторные запросы берутся из LRU-кэша"""
+        key = (self.openai_embedding_model, " ".join(text.split()))
+        with self._query_embeddings_lock:
+            cached = self._query_embeddings.get(key)
+        if cached is not None:
+            return cached
         try:
-            response = self.openai_client.embeddings.create(
-                model=self.openai_embedding_model,
-                input=text,
-                encoding_format="float"
-            )
-            return response.data[0].embedding
+            embedding = self._get_openai_embeddings([text])[0]
         except Exception as e:
             logger.error(f"Failed to get embedding: {e}")
             return None
+        embedding.flags.writeable = False
+        with self._query_embeddings_lock:
+            self._query_embeddings[key] = embedding
+        return embedding
+
+    @retry(retry=retry_if_exception_type(RateLimitError), wait=wait_exponential_jitter(initial=1, max=30),
+           stop=stop_after_attempt(5), reraise=True)
+    def _get_openai_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Эмбеддинги списка текстов одним запросом: float32 матрица (кол-во текстов, d) в том же порядке;
+        при 429 — повтор с задержкой"""
+        response = self.openai_client.embeddings.create(
+            model=self.openai_embedding_model,
+            input=texts,
+            encoding_format="float"
+        )
+        return np.asarray([item.embedding for item in response.data], dtype=np.float32)
 
     def _build_semantic_index(self):
         """Создание базы для документов"""
+        self.document_embeddings = np.array([])
         if not self.document_mappings:
             self.document_names = []
-            self.document_embeddings = np.array([])
             return
         
         self.document_names = list(self.document_mappings.keys())
-        embeddings = []
-        
+        texts = []
         for doc_name in self.document_names:
-            searchable_text = f"{doc_name} {doc_name.lower()} {re.sub(r'[_\\-]', ' ', doc_name.lower())}"
-            embedding = self._get_openai_embedding(searchable_text)
-            if embedding:
-                embeddings.append(embedding)
-        
-        if embeddings:
-            self.document_embeddings = np.array(embeddings)
-            logger.info(f"Built semantic index for {len(embeddings)} documents")
-        else:
-            self.document_embeddings = np.array([])
+            name_lower = doc_name.lower()
+            texts.append(f"{doc_name} {name_lower} {_NAME_SEP_RE.sub(' ', name_lower)}")
+        
+        # Названия отправляются батчами — один HTTP-запрос на EMBEDDING_BATCH_SIZE документов
+        try:
+            embeddings = np.vstack([
+                self._get_openai_embeddings(texts[start:start + EMBEDDING_BATCH_SIZE])
+                for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+            ])
+        except Exception as e:
+            logger.error(f"Failed to get embeddings: {e}")
+            return
+        
+        self.document_embeddings = _normalize_rows(embeddings)
+        logger.info(f"Built semantic index for {len(embeddings)} documents")
 
     def _get_document_list_summary(self) -> str:
         """Информация о доступных документах"""
@@ -229,42 +408,63 @@ Now analyze the user query and decide whether to retrieve a document, search the
             return "No documents available"
         return f"{len(self.document_mappings)} documents including: " + ", ".join(list(self.document_mappings.keys())[:5]) + "..."
 
-    def _find_document_semantic(self, query: str) -> Optional[Tuple[str, str, float]]:
-        """Поиск документов по запросу пользователя"""
-        if len(self.document_embeddings) == 0:
-            return None
+    def _find_document_candidates(self, query: str, k: int = 5) -> List[Tuple[str, str, float]]:
+        """Top-k документов по семантической близости к запросу (выше порога), по убыванию score"""
+        if self.document_index is None:
+            return []
         
         query_embedding = self._get_openai_embedding(query)
-        if not query_embedding:
-            return None
-        
-        query_embedding = np.array(query_embedding).reshape(1, -1)
-        similarities = cosine_similarity(query_embedding, self.document_embeddings)[0]
-        best_idx = np.argmax(similarities)
-        
-        if similarities[best_idx] > 0.3:  # порог
-            doc_name = self.document_names[best_idx]
-            doc_path = self.document_mappings[doc_name]
-            if os.path.exists(doc_path):
-                return doc_name, doc_path, similarities[best_idx]
-        
-        return None
+        if query_embedding is None:
+            return []
+        
+        # Эмбеддинги документов нормализованы при загрузке — нормализуется только запрос;
+        # поиск top-k — SIMD-ядра FAISS (IndexFlatIP), результаты уже по убыванию score
+        query_vector = (query_embedding / max(float(np.linalg.norm(query_embedding)), 1e-12))[None, :]
+        scores, ids = self.document_index.search(np.ascontiguousarray(query_vector, dtype=np.float32), k)
+        
+        candidates = []
+        for idx, score in zip(ids[0], scores[0]):
+            if idx < 0 or score <= 0.3:  # порог
+                break
+            doc_name = self.document_names[idx]
+            candidates.append((doc_name, self.document_mappings[doc_name], float(score)))
+        logger.debug("Document candidates for '%s': %s", query, candidates)
+        return candidates
 
     def retrieve_document(self, document_query: str) -> Dict[str, Any]:
         """Достать документ с помощью семантического поиска"""
-        logger.info(f"Searching for document: '{document_query}'")
+        logger.info("Searching for document: '%s'", document_query)
         
         # Попробовать найти по полному названию
-        for doc_name, doc_path in self.document_mappings.items():
-            if document_query.lower() in doc_name.lower() or doc_name.lower() in document_query.lower():
-                if os.path.exists(doc_path):
+        query_lower = document_query.lower()
+        for name_lower, doc_name, doc_path in self._document_names_lower:
+            if query_lower in name_lower or name_lower in query_lower:
+                if doc_path in self._document_sizes:
                     return self._create_document_response(doc_name, doc_path, 1.0, "exact_match")
         
-        # Семантический поиск
-        result = self._find_document_semantic(document_query)
-        if result:
-            doc_name, doc_path, score = result
-            return self._create_document_response(doc_name, doc_path, score, "semantic_match")
+        # Совпадение по словам: единственный документ, с отличительными словами названия которого у запроса
+        # >= 2 общих слов, — без запроса эмбеддинга. При равенстве нескольких документов — семантический поиск
+        query_tokens = _document_tokens(query_lower)
+        if len(query_tokens) >= 2:
+            overlaps = sorted(
+                ((len(query_tokens & tokens), doc_name, doc_path, len(tokens))
+                 for tokens, doc_name, doc_path in self._document_tokens),
+                key=lambda item: item[0],
+                reverse=True
+            )
+            if overlaps and overlaps[0][0] >= 2 and (len(overlaps) == 1 or overlaps[1][0] < overlaps[0][0]):
+                overlap, doc_name, doc_path, total = overlaps[0]
+                return self._create_document_response(doc_name, doc_path, overlap / total, "token_overlap")
+        
+        # Семантический поиск: лучший документ и остальные кандидаты для уточнения
+        candidates = self._find_document_candidates(document_query)
+        if candidates and candidates[0][1] in self._document_sizes:
+            doc_name, doc_path, score = candidates[0]
+            result = self._create_document_response(doc_name, doc_path, score, "semantic_match")
+            result["alternative_documents"] = [
+                name for name, path, _ in candidates[1:] if path in self._document_sizes
+            ]
+            return result
         
         # Нет результата
         return {
@@ -275,8 +475,7 @@ Now analyze the user query and decide whether to retrieve a document, search the
 
     def _create_document_response(self, doc_name: str, doc_path: str, score: float, match_type: str) -> Dict[str, Any]:
         """Стандартный ответ документа"""
-        file_stat = os.stat(doc_path)
-        file_size_mb = file_stat.st_size / (1024 * 1024)
+        file_size_mb = self._document_sizes[doc_path] / (1024 * 1024)
         
         return {
             "success": True,
@@ -288,39 +487,17 @@ Now analyze the user query and decide whether to retrieve a document, search the
             "message": f"Document '{doc_name}' found and ready for download."
         }
 
-    def search_knowledge_base(self, query: str, mode: str = "generated", num_queries: int = 3) -> Dict[str, Any]:
-        """Поиск по базе данных с генерацией дополнительных запросов"""
+    def search_knowledge_base(self, query: str, mode: str = "generated", num_queries: int = 3,
+                              context: Optional[str] = None) -> Dict[str, Any]:
+        """Поиск по базе данных с генерацией дополнительных запросов (context — история разговора, если уже получена)"""
         try:
-            logger.info(f"Searching knowledge base: '{query}' in {mode} mode")
-            
-            # Загрузка базы данны 
-            vectorstore = FAISS.load_local(
-                self.local_index_path,
-                embeddings=self.embedding_model,
-                allow_dangerous_deserialization=True
-            )
-            retriever = vectorstore.as_retriever()
-            
-            # Генерация дополнительных запросов
-            if mode == "generated":
-                # История для контекста
+            logger.info("Searching knowledge base: '%s' in %s mode", query, mode)
+            # История для генерации запросов и ответа берется один раз
+            if context is None:
                 context = self._get_conversation_context()
-                queries = self._generate_queries(query, num_queries, context)
-            else:
-                queries = [query]
-            
-            # Достать документы
-            all_docs = []
-            for q in queries:
-                docs = retriever.invoke(q)
-                all_docs.append(docs)
-            
-            # Повторная оценка результатов 
-            fused_docs = self._reciprocal_rank_fusion(all_docs)
-            top_docs = fused_docs[:3]  # Toп 3 документа
+            queries, top_docs = self._retrieve_documents(query, mode, num_queries, context)
             
             # Сгенерировать ответ 
-            context = self._get_conversation_context()
             answer = self._generate_answer(query, top_docs, context)
             
             return {
@@ -331,162 +508,175 @@ Now analyze the user query and decide whether to retrieve a document, search the
             }
             
         except Exception as e:
-            logger.error(f"Error in knowledge base search: {str(e)}")
+            logger.error("Error in knowledge base search: %s", e)
             return {
                 "answer": f"Error searching knowledge base: {str(e)}",
                 "success": False,
                 "error": str(e)
             }
 
+    def _retrieve_documents(self, query: str, mode: str, num_queries: int, context: str) -> Tuple[List[str], List[Any]]:
+        """Генерация запросов, поиск и RRF. Returns: (использованные запросы, топ документов)"""
+        vectorstore = self._get_vectorstore()
+        
+        # Генерация дополнительных запросов
+        if mode == "generated":
+            queries = self._generate_queries(query, num_queries, context)
+        else:
+            queries = [query]
+        
+        # Достать id документов: по строке на каждый запрос
+        all_ids = self._similarity_search(vectorstore, queries)
+        
+        # Повторная оценка результатов 
+        fused_ids = self._reciprocal_rank_fusion(all_ids, top_n=3)
+        top_docs = [  # Toп 3 документа
+            vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+            for i in fused_ids
+        ]
+        return queries, top_docs
+
+    def _get_vectorstore(self) -> FAISS:
+        """Общая база, загруженная при старте; иначе загружается с диска один раз (в фоне при создании агента или при первом поиске)"""
+        if self.vectorstore is None:
+            with self._vectorstore_lock:
+                if self.vectorstore is None:
+                    self.vectorstore = load_vectorstore(self.local_index_path, self.embedding_model)
+        return self.vectorstore
+
+    def _similarity_search(self, vectorstore, queries: List[str], k: int = 4) -> np.ndarray:
+        """Поиск по FAISS (аналог retriever.invoke) сразу для всех запросов: один батч эмбеддингов и один index.search
+        Returns: (кол-во запросов, k) id документов в индексе по рангу (-1 — нет результата)"""
+        # Результаты поиска по тем же запросам (повторные и уточняющие вопросы) берутся из кэша
+        keys = [(id(vectorstore), k, " ".join(q.split())) for q in queries]
+        with self._retrieval_cache_lock:
+            rows = [self._retrieval_cache.get(key) for key in keys]
+        misses = [i for i, row in enumerate(rows) if row is None]
+        if not misses:
+            return np.vstack(rows)
+        miss_queries = [queries[i] for i in misses]
+        
+        # CachedEmbeddings сразу отдает float32 матрицу (из кэша — без запроса к OpenAI)
+        embed_array = getattr(self.embedding_model, "embed_documents_array", None)
+        if embed_array is not None:
+            vectors = embed_array(miss_queries)
+        else:
+            vectors = np.asarray(self.embedding_model.embed_documents(miss_queries), dtype=np.float32)
+        if vectorstore._normalize_L2:
+            # normalize_L2 меняет массив на месте — кэшированные векторы не трогаем
+            vectors = np.array(vectors, dtype=np.float32)
+            faiss.normalize_L2(vectors)
+        
+        if self.search_batcher is not None:
+            _, indices = self.search_batcher.search(vectorstore.index, vectors, k)
+        else:
+            _, indices = vectorstore.index.search(np.ascontiguousarray(vectors, dtype=np.float32), k)
+        
+        indices = np.array(indices)  # собственная копия: строки кэшируются только для чтения
+        indices.flags.writeable = False
+        with self._retrieval_cache_lock:
+            for i, row in zip(misses, indices):
+                rows[i] = self._retrieval_cache[keys[i]] = row
+        return np.vstack(rows)
+
     def _generate_queries(self, original_query: str, n: int, chat_context: str = "") -> List[str]:
         """Генерация дополнительных запросов для поиска по базе данных"""
-        prompt = query_generation_prompt
-        chain = prompt | self.llm | StrOutputParser()
-        
+        key = (original_query, n, chat_context)
+        with self._generated_queries_lock:
+            cached = self._generated_queries.get(key)
+        if cached is not None:
+            return list(cached)
+
         # Включить предыдущий разговор для контекста
-        result = chain.invoke({
+        result = self._query_chain.invoke({
             "query": original_query, 
             "n": n,
             "chat_context": chat_context or "No previous conversation context."
         })
         
-        queries = [q.strip() for q in result.split("\n") if q.strip()]
+        queries = _QUERY_RE.findall(result)[:n]
         
         # Хотя бы оригинальный запрос 
         if not queries:
             queries = [original_query]
         
         # Логирование дополнительных заппросов
-        logger.info(f"Generated {len(queries)} queries with context: {queries}")
+        logger.debug("Generated %s queries with context: %s", len(queries), queries)
         
-        return queries[:n]
+        with self._generated_queries_lock:
+            self._generated_queries[key] = tuple(queries)
+        return queries
 
-    def _reciprocal_rank_fusion(self, results: List[List[Any]], k: int = 3) -> List[Any]:
-        """Сортировка результатов"""
-        fused_scores = {}
-        
-        for docs in results:
-            for rank, doc in enumerate(docs):
-                doc_key = doc.page_content[:100]  # Use first 100 chars as key
-                if doc_key not in fused_scores:
-                    fused_scores[doc_key] = {"score": 0, "doc": doc}
-                fused_scores[doc_key]["score"] += 1 / (rank + k)
-        
-        sorted_docs = sorted(fused_scores.values(), key=lambda x: x["score"], reverse=True)
-        return [item["doc"] for item in sorted_docs]
+    def _reciprocal_rank_fusion(self, results: np.ndarray, k: int = 3, top_n: Optional[int] = None) -> np.ndarray:
+        """Сортировка результатов: RRF по id документов FAISS (одинаковые чанки совпадают по id), top_n лучших"""
+        # rrf_fuse при равном score ставит первым меньший id; чтобы порядок был как раньше
+        # (исходный запрос, затем ранг), id FAISS заменяются плотными id в порядке первого появления
+        flat = results.ravel()
+        valid = flat >= 0
+        faiss_ids, first_seen, inverse = np.unique(flat[valid], return_index=True, return_inverse=True)
+        seen_order = np.argsort(first_seen)
+        dense_of = np.empty_like(seen_order)
+        dense_of[seen_order] = np.arange(seen_order.shape[0])
+        dense = np.full(flat.shape, -1, dtype=np.int64)
+        dense[valid] = dense_of[inverse]
+        fused_ids, _ = rrf_fuse(dense.reshape(results.shape), k, top_n)
+        return faiss_ids[seen_order][fused_ids]
 
-    def _generate_answer(self, query: str, documents: List[Any], context: str) -> str:
-        """Сгенерировать ответ для генерации """
-        prompt = chatbot_prompt
+    def _answer_inputs(self, query: str, documents: List[Any], context: str) -> Dict[str, str]:
         doc_contents = "\n\n".join([f"Exracted from: {doc.metadata['doc_info']}: {doc.page_content}" for doc in documents])
-        
-        chain = prompt | self.llm | StrOutputParser()
-        return chain.invoke({
+        return {
             "query": query,
             "documents": doc_contents,
             "context": context
-        })
+        }
+
+    def _generate_answer(self, query: str, documents: List[Any], context: str) -> str:
+        """Сгенерировать ответ для генерации """
+        return self._answer_chain.invoke(self._answer_inputs(query, documents, context))
+
+    def _stream_answer(self, query: str, documents: List[Any], context: str) -> Iterator[str]:
+        """Генерация ответа по частям (токены по мере поступления от LLM)"""
+        yield from self._answer_chain.stream(self._answer_inputs(query, documents, context))
 
     def _get_conversation_context(self) -> str:
         """Форматирование разговора для контекста"""
-        if not self.conversation_history:
-            return "No previous conversation."
-        
-        context_parts = []
-        for turn in self.conversation_history[-self.memory_window_size:]:
-            context_parts.append(f"User: {turn['user']}")
-            context_parts.append(f"Assistant: {turn['assistant']}")
-        
-        return "\n".join(context_parts)
+        with self._memory_lock:
+            return self._conversation_context
 
     def _update_memory(self, user_query: str, response: str):
         """Обновление памяти разговора"""
-        self.conversation_history.append({
-            "user": user_query,
-            "assistant": response,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        # Последние N разговоров
-        if len(self.conversation_history) > self.memory_window_size:
-            self.conversation_history = self.conversation_history[-self.memory_window_size:]
-        
-        # Обновление памяти
-        self.memory.save_context({"input": user_query}, {"answer": response})
+        with self._memory_lock:
+            self.conversation_history.append({
+                "user": user_query,
+                "assistant": response,
+                "timestamp": datetime.now().isoformat()
+            })
+            # Снимок окна: deque нельзя обходить, пока в него добавляют
+            turns = list(self.conversation_history)
+            self._conversation_context = "\n".join(
+                f"User: {turn['user']}\nAssistant: {turn['assistant']}" for turn in turns
+            )
+            
+            # Обновление памяти (под тем же lock: обрезка не должна удалить сообщения, сохраненные другим запросом)
+            self.memory.save_context({"input": user_query}, {"answer": response})
+            # Только последние memory_window_size обменов (2 сообщения на обмен), как и в conversation_history —
+            # иначе буфер копит всю переписку за время жизни агента
+            del self.memory.chat_memory.messages[:-2 * self.memory_window_size]
 
-    def process_query(self, user_query: str, verbose: bool = False) -> Tuple[str, Dict[str, Any]]:
+    def process_query(self, user_query: str, verbose: bool = False,
+                      context: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
         """
         Основная функция для обработки запроса
+        context: история разговора сессии; None — общая память агента
         Returns:
             Tuple of (answer, metadata)
         """
-        metadata = {
-            "user_query": user_query,
-            "timestamp": datetime.now().isoformat(),
-            "decision": None,
-            "success": False,
-            "total_cost": 0.0
-        }
+        metadata = self._new_metadata(user_query)
+        context = self._resolve_context(context)
         
         try:
-            context = self._get_conversation_context()
-            
-            chain = self.decision_prompt | self.llm.bind(
-                functions=self.function_definitions,
-                function_call="auto"
-            )
-            
-            with get_openai_callback() as cb:
-                response = chain.invoke({
-                    "user_query": user_query,
-                    "chat_context": context
-                })
-                metadata["decision_cost"] = cb.total_cost
-                metadata["total_cost"] += cb.total_cost
-            
-            if hasattr(response, 'additional_kwargs') and 'function_call' in response.additional_kwargs:
-                function_call = response.additional_kwargs['function_call']
-                function_name = function_call['name']
-                function_args = json.loads(function_call['arguments'])
-                
-                metadata["decision"] = function_name
-                metadata["function_args"] = function_args
-                
-                if function_name == "retrieve_document":
-                    # Возрращение документа
-                    result = self.retrieve_document(function_args['document_query'])
-                    if result['success']:
-                        answer = (
-                            f"Найден документ: **{result['document_name']}**\n\n"
-                            f"Файл: {os.path.basename(result['file_path'])}\n"
-                            f"Размер: {result['file_size_mb']} MB\n"
-                            # f"Расположение: {result['file_path']}\n"
-                            f"Соответствие: {result['match_type']} (score: {result['match_score']})"
-                        )
-                    else:
-                        answer = result['message']
-                        if result.get('available_documents'):
-                            answer += f"\n\nAvailable documents:\n" + "\n".join(
-                                [f"• {doc}" for doc in result['available_documents'][:10]]
-                            )
-                    metadata.update(result)
-                
-                elif function_name == "search_knowledge_base":
-                    # Поиск по базе знаний
-                    result = self.search_knowledge_base(
-                        query=function_args.get('query', user_query),
-                        mode=function_args.get('mode', 'generated'),
-                        num_queries=function_args.get('num_queries', 3)
-                    )
-                    answer = result['answer']
-                    metadata.update(result)
-                
-                else:
-                    answer = "Unknown function called"
-            
-            else:
-                metadata["decision"] = "direct_answer"
-                answer = response.content
+            response = self._decide(user_query, metadata, context)
+            answer = self._answer_decision(response, user_query, metadata, context)
             
             self._update_memory(user_query, answer)
             metadata["success"] = True
@@ -498,12 +688,146 @@ Now analyze the user query and decide whether to retrieve a document, search the
             
         except Exception as e:
             print(e)
-            logger.error(f"Error processing query: {str(e)}")
+            logger.error("Error processing query: %s", e)
             error_msg = f"I encountered an error: {str(e)}"
             metadata["error"] = str(e)
             metadata["success"] = False
             return error_msg, metadata
 
+    def process_query_stream(self, user_query: str, context: Optional[str] = None) -> Iterator[Tuple[str, Any]]:
+        """
+        Потоковая версия process_query (для SSE): ответ из базы знаний отдается токенами по мере генерации,
+        остальные ответы — одной частью
+        Yields:
+            ("delta", часть ответа), в конце ("done", (answer, metadata))
+        """
+        metadata = self._new_metadata(user_query)
+        context = self._resolve_context(context)
+        
+        try:
+            response = self._decide(user_query, metadata, context)
+            function_call = response.additional_kwargs.get('function_call') if hasattr(response, 'additional_kwargs') else None
+            
+            if function_call and function_call['name'] == "search_knowledge_base":
+                function_args = orjson.loads(function_call['arguments'])
+                metadata["decision"] = "search_knowledge_base"
+                metadata["function_args"] = function_args
+                
+                query = function_args.get('query', user_query)
+                queries, top_docs = self._retrieve_documents(
+                    query,
+                    function_args.get('mode', 'generated'),
+                    function_args.get('num_queries', 3),
+                    context
+                )
+                parts = []
+                for chunk in self._stream_answer(query, top_docs, context):
+                    parts.append(chunk)
+                    yield "delta", chunk
+                answer = "".join(parts)
+                metadata.update({
+                    "answer": answer,
+                    "queries_used": queries,
+                    "num_documents": len(top_docs)
+                })
+            else:
+                answer = self._answer_decision(response, user_query, metadata, context)
+                yield "delta", answer
+            
+            self._update_memory(user_query, answer)
+            metadata["success"] = True
+            
+        except Exception as e:
+            logger.error("Error processing query: %s", e)
+            answer = f"I encountered an error: {str(e)}"
+            metadata["error"] = str(e)
+            metadata["success"] = False
+        
+        yield "done", (answer, metadata)
+
+    def _new_metadata(self, user_query: str) -> Dict[str, Any]:
+        return {
+            "user_query": user_query,
+            "timestamp": datetime.now().isoformat(),
+            "decision": None,
+            "success": False,
+            "total_cost": 0.0
+        }
+
+    def _resolve_context(self, context: Optional[str]) -> str:
+        """Контекст сессии, если передан, иначе общая память агента"""
+        if context is None:
+            return self._get_conversation_context()
+        return context or "No previous conversation."
+
+    def _decide(self, user_query: str, metadata: Dict[str, Any], context: str):
+        """Выбор действия LLM через function calling"""
+        messages = [
+            self._decision_system,
+            # История разговора отдельным сообщением после неизменной части — префикс кэшируется OpenAI
+            SystemMessage(content=f"Conversation context so far:\n{context}"),
+            HumanMessage(content=user_query)
+        ]
+        
+        with get_openai_callback() as cb:
+            response = self._decision_llm.invoke(messages)
+            metadata["decision_cost"] = cb.total_cost
+            metadata["total_cost"] += cb.total_cost
+        
+        # Сколько токенов промпта взято из кэша OpenAI (проверка prefix caching)
+        usage = getattr(response, "usage_metadata", None) or {}
+        metadata["decision_cached_tokens"] = usage.get("input_token_details", {}).get("cache_read", 0)
+        return response
+
+    def _answer_decision(self, response, user_query: str, metadata: Dict[str, Any], context: str) -> str:
+        """Выполнение выбранного действия и формирование ответа"""
+        if hasattr(response, 'additional_kwargs') and 'function_call' in response.additional_kwargs:
+            function_call = response.additional_kwargs['function_call']
+            function_name = function_call['name']
+            function_args = orjson.loads(function_call['arguments'])
+            
+            metadata["decision"] = function_name
+            metadata["function_args"] = function_args
+            
+            if function_name == "retrieve_document":
+                # Возрращение документа
+                result = self.retrieve_document(function_args['document_query'])
+                if result['success']:
+                    answer = (
+                        f"Найден документ: **{result['document_name']}**\n\n"
+                        f"Файл: {os.path.basename(result['file_path'])}\n"
+                        f"Размер: {result['file_size_mb']} MB\n"
+                        # f"Расположение: {result['file_path']}\n"
+                        f"Соответствие: {result['match_type']} (score: {result['match_score']})"
+                    )
+                else:
+                    answer = result['message']
+                    if result.get('available_documents'):
+                        answer += f"\n\nAvailable documents:\n" + "\n".join(
+                            [f"• {doc}" for doc in result['available_documents'][:10]]
+                        )
+                metadata.update(result)
+            
+            elif function_name == "search_knowledge_base":
+                # Поиск по базе знаний
+                result = self.search_knowledge_base(
+                    query=function_args.get('query', user_query),
+                    mode=function_args.get('mode', 'generated'),
+                    num_queries=function_args.get('num_queries', 3),
+                    context=context
+                )
+                answer = result['answer']
+                metadata.update(result)
+            
+            else:
+                answer = "Unknown function called"
+        
+        else:
+            metadata["decision"] = "direct_answer"
+            answer = response.content
+        
+        return answer
+
     def _print_verbose_output(self, metadata: Dict[str, Any]):
         """Распечатка результатов"""
         print(f"\n{'='*60}")
@@ -534,12 +858,19 @@ Now analyze the user query and decide whether to retrieve a document, search the
 
     def get_conversation_history(self) -> List[Dict[str, Any]]:
         """Возвращает историю переписки"""
-        return self.conversation_history
+        with self._memory_lock:
+            return list(self.conversation_history)
+
+    def record_exchange(self, user_query: str, response: str):
+        """Записать в память обмен, ответ на который получен без агента (например, из кэша ответов)"""
+        self._update_memory(user_query, response)
 
     def clear_memory(self):
         """Очистка памяти"""
-        self.conversation_history = []
-        self.memory.clear()
+        with self._memory_lock:
+            self.conversation_history.clear()
+            self._conversation_context = "No previous conversation."
+            self.memory.clear()
         logger.info("Conversation memory cleared")
 
     def list_documents(self) -> str:
@@ -549,7 +880,7 @@ Now analyze the user query and decide whether to retrieve a document, search the
         
         doc_list = []
         for i, (name, path) in enumerate(self.document_mappings.items(), 1):
-            exists = "EXISTS:" if os.path.exists(path) else "NOT:"
+            exists = "EXISTS:" if path in self._document_sizes else "NOT:"
             doc_list.append(f"{i}. {exists} {name}")
         
         return f"**Available Documents ({len(self.document_mappings)}):**\n" + "\n".join(doc_list)
@@ -561,6 +892,8 @@ def create_unified_rag_agent(
     document_embeddings_path: str,
     openai_api_key: Optional[str] = None,
     memory_window_size: int = 10,
+    search_batcher=None,
+    vectorstore: Optional[FAISS] = None,
 ) -> UnifiedRAGAgent:
     """
     Создание объекта агента
@@ -571,6 +904,8 @@ def create_unified_rag_agent(
         documents_json_path: путь до JSON с названиями и адресами документов
         openai_api_key: OpenAI API key
         memory_window_size: окно разговора для добавления в контекст
+        search_batcher: общий SearchBatcher для поисков FAISS
+        vectorstore: уже загруженная база FAISS
     
     Returns:
         UnifiedRAGAgent instance
@@ -583,5 +918,7 @@ def create_unified_rag_agent(
         openai_embedding_model="text-embedding-3-small",
         openai_api_key=openai_api_key,
         memory_window_size=memory_window_size,
-        document_embeddings_path=document_embeddings_path
+        document_embeddings_path=document_embeddings_path,
+        search_batcher=search_batcher,
+        vectorstore=vectorstore
     )
\ No newline at end of file
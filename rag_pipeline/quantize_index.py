@@ -0,0 +1,70 @@
+# Скрипт для квантования готовой векторной базы FAISS (FP32 -> int8 / PQ).
+# Векторы берутся из существующего индекса, поэтому повторно считать эмбеддинги через OpenAI не нужно.
+# Порядок векторов сохраняется, так что index.pkl (docstore и index_to_docstore_id) копируется без изменений,
+# и сервер загружает новую базу обычным FAISS.load_local.
+
+import argparse
+import shutil
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+"""
+ОБЯЗАТЕЛЬНЫЕ ПАРАМЕТРЫ СКРИПТА:
+- vectorstore — папка с исходной базой FAISS (index.faiss + index.pkl)
+- output — папка для квантованной базы
+ДОПОЛНИТЕЛЬНЫЕ ПАРАМЕТРЫ:
+- factory — строка faiss.index_factory: "SQ8" (по умолчанию, int8, в 4 раза меньше памяти),
+  "HNSW32" (графовый поиск за ~log(N) без потери точности на малых базах),
+  "IVF{nlist},PQ{m}" или "OPQ64_256,IVF4096,PQ64x8" для больших баз (для IVF нужно >= 39 * nlist векторов),
+  "auto" — HNSW32 до 100 тыс. векторов, иначе OPQ64_256,IVF{4*sqrt(N)},PQ64x8
+- train_size — сколько случайных векторов использовать для обучения (IVF/PQ), по умолчанию 100000
+- metric — "keep" (по умолчанию, метрика исходного индекса) или "ip": векторы нормализуются и индекс строится
+  по скалярному произведению (= косинусная близость, быстрые SIMD-ядра FAISS), например --factory Flat --metric ip
+"""
+parser = argparse.ArgumentParser(description="FAISS index quantization script")
+parser.add_argument("vectorstore", help="Папка с исходной базой FAISS")
+parser.add_argument("output", help="Папка для квантованной базы FAISS")
+parser.add_argument("--factory", default="SQ8", help="Тип индекса для faiss.index_factory или auto (по умолчанию SQ8)")
+parser.add_argument("--train_size", type=int, default=100000, help="Кол-во векторов для обучения индекса")
+parser.add_argument("--metric", choices=["keep", "ip"], default="keep", help="Метрика нового индекса")
+
+args = parser.parse_args()
+
+source = Path(args.vectorstore)
+output = Path(args.output)
+if not (source / "index.faiss").is_file() or not (source / "index.pkl").is_file():
+    raise FileNotFoundError(f"FAISS vectorstore not found in {source}")
+
+index = faiss.read_index(str(source / "index.faiss"))
+vectors = index.reconstruct_n(0, index.ntotal)
+
+factory = args.factory
+if factory == "auto":
+    if index.ntotal < 100000:
+        factory = "HNSW32"
+    else:
+        factory = f"OPQ64_256,IVF{int(4 * np.sqrt(index.ntotal))},PQ64x8"
+
+# Метрика сохраняется (L2 у LangChain по умолчанию или IP для нормализованных векторов)
+metric = index.metric_type
+if args.metric == "ip":
+    # Нормализация один раз при построении; запросы нормализует сервер (rag_pipeline/vectorstore.py)
+    faiss.normalize_L2(vectors)
+    metric = faiss.METRIC_INNER_PRODUCT
+quantized = faiss.index_factory(index.d, factory, metric)
+if not quantized.is_trained:
+    # Обучение на случайной выборке; добавляются все векторы в исходном порядке
+    sample = vectors
+    if index.ntotal > args.train_size:
+        sample = vectors[np.random.default_rng(0).choice(index.ntotal, args.train_size, replace=False)]
+    quantized.train(sample)
+quantized.add(vectors)
+
+output.mkdir(parents=True, exist_ok=True)
+faiss.write_index(quantized, str(output / "index.faiss"))
+shutil.copyfile(source / "index.pkl", output / "index.pkl")
+
+print(f"Quantized {index.ntotal} vectors ({factory}): "
+      f"{(source / 'index.faiss').stat().st_size / 1e6:.1f} MB -> {(output / 'index.faiss').stat().st_size / 1e6:.1f} MB")
@@ -1,12 +1,19 @@
 import os
-import json
+import re
 import logging
 from typing import List, Tuple, Optional, Any, Dict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from cachetools import LRUCache
+import numpy as np
+import faiss
 from dotenv import load_dotenv
 from langchain_community.vectorstores import FAISS
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langchain.callbacks.manager import get_openai_callback
+from rag_pipeline.vectorstore import load_vectorstore as _load_vectorstore
+from rag_pipeline.rrf import rrf_fuse
 # from .prompts import query_generation_prompt, summary_prompt
 
 logging.basicConfig(level=logging.INFO)
@@ -18,38 +25,92 @@ DEFAULT_PARAMS = {
     "model": "gpt-4o"
 }
 
-def reciprocal_rank_fusion(results: List[List[Any]], k: int = 3) -> List[Tuple[Any, float]]:
-    fused_scores = {}
-    for docs in results:
-        for rank, doc in enumerate(docs):
-            # Use (page_content, sorted(metadata)) as a unique key
-            doc_key = json.dumps({
-                "page_content": doc.page_content,
-                "metadata": doc.metadata
-            }, sort_keys=True)
-            if doc_key not in fused_scores:
-                fused_scores[doc_key] = {"score": 0, "doc": doc}
-            fused_scores[doc_key]["score"] += 1 / (rank + k)
-    
-    reranked_results = [
-        (entry["doc"], entry["score"])
-        for entry in sorted(fused_scores.values(), key=lambda x: x["score"], reverse=True)
-    ]
-    return reranked_results
+# One generated query per non-empty line, without "1." / "2)" / "-" list markers
+_QUERY_RE = re.compile(r"^\s*(?:(?:\d+[.)]|[-*•])\s+)?(.+?)\s*$", re.M)
+
+# Speculative retrieval of the original query while sub-queries are being generated
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-fusion")
+
+def reciprocal_rank_fusion(results: List[List[Any]], k: int = 3, top_n: Optional[int] = None) -> List[Tuple[Any, float]]:
+    # The docstore returns the same Document object for the same chunk, so identity is a unique key;
+    # docs get dense ids in first-seen order and are scored by the vectorized rrf_fuse (same tie order)
+    id_map: Dict[int, int] = {}
+    docs: List[Any] = []
+    ids = np.full((len(results), max((len(r) for r in results), default=0)), -1, dtype=np.int64)
+    for row, result in enumerate(results):
+        for rank, doc in enumerate(result):
+            doc_id = id_map.setdefault(id(doc), len(docs))
+            if doc_id == len(docs):
+                docs.append(doc)
+            ids[row, rank] = doc_id
+    if not docs:
+        return []
+    fused_ids, scores = rrf_fuse(ids, k, top_n)
+    return [(docs[i], float(score)) for i, score in zip(fused_ids, scores)]
+
+# LLM clients, chains and retrievers are stateless after construction: build once, reuse on every call
+_llms: Dict[str, ChatOpenAI] = {}
+_chains: Dict[Tuple[str, int], Any] = {}
+_retrievers: Dict[int, Any] = {}
 
 def get_llm(params: Optional[dict] = None):
     # For langchain_openai, most params are keyword args
-    return ChatOpenAI(**(params or DEFAULT_PARAMS))
+    params = params or DEFAULT_PARAMS
+    key = repr(sorted(params.items()))
+    llm = _llms.get(key)
+    if llm is None:
+        llm = _llms[key] = ChatOpenAI(**params)
+    return llm
+
+def get_chain(name: str, prompt, llm):
+    """prompt | llm | StrOutputParser(), cached per (name, llm); the cached chain keeps llm alive, so its id is stable"""
+    key = (name, id(llm))
+    chain = _chains.get(key)
+    if chain is None:
+        chain = _chains[key] = prompt | llm | StrOutputParser()
+    return chain
+
+def get_retriever(vectorstore: FAISS):
+    # The cached retriever references its vectorstore, so id(vectorstore) cannot be reused while cached
+    retriever = _retrievers.get(id(vectorstore))
+    if retriever is None or retriever.vectorstore is not vectorstore:
+        retriever = _retrievers[id(vectorstore)] = vectorstore.as_retriever()
+    return retriever
+
+# Загруженные базы по (путь, модель эмбеддингов): индекс неизменен, читать с диска его нужно один раз
+_vectorstores: Dict[Tuple[str, int], FAISS] = {}
 
 def load_vectorstore(local_index_path: str, embedding_model):
     # Note: langchain_community.vectorstores
-    return FAISS.load_local(local_index_path, embeddings=embedding_model, allow_dangerous_deserialization=True)
+    key = (local_index_path, id(embedding_model))
+    vectorstore = _vectorstores.get(key)
+    if vectorstore is None:
+        # Общий загрузчик (mmap индекса, метрика по типу индекса), как у агента и API
+        vectorstore = _vectorstores[key] = _load_vectorstore(local_index_path, embedding_model)
+    return vectorstore
+
+# Query generation depends only on its input: (query, llm, n) -> (queries, metadata)
+_generated_queries: LRUCache = LRUCache(maxsize=5000)
+_generated_queries_lock = threading.Lock()
 
 def generate_queries(query: str, llm, n: int) -> Tuple[List[str], Dict[str, Any]]:
-    """Generate queries and return both queries and metadata"""
-    prompt = query_generation_prompt
-    output_parser = StrOutputParser()
-    chain = prompt | llm | output_parser
+    """Generate queries and return both queries and metadata (repeated questions are served from cache)"""
+    # llm instances are cached in _llms for the process lifetime, so id(llm) is a stable key
+    key = (query, id(llm), n)
+    with _generated_queries_lock:
+        cached = _generated_queries.get(key)
+    if cached is not None:
+        queries, metadata = cached
+        # Copies for the caller; nothing was spent on this call
+        return list(queries), {**dict.fromkeys(metadata, 0), "cache_hit": True}
+
+    queries, metadata = _generate_queries(query, llm, n)
+    with _generated_queries_lock:
+        _generated_queries[key] = (list(queries), dict(metadata))
+    return queries, metadata
+
+def _generate_queries(query: str, llm, n: int) -> Tuple[List[str], Dict[str, Any]]:
+    chain = get_chain("query_generation", query_generation_prompt, llm)
     
     # Track token usage for query generation
     with get_openai_callback() as cb:
@@ -64,19 +125,33 @@ def generate_queries(query: str, llm, n: int) -> Tuple[List[str], Dict[str, Any]
         "successful_requests": cb.successful_requests
     }
     
-    queries = queries.split("\n")
-    filtered_queries = [q.strip() for q in queries if q.strip()][:n]
-    return filtered_queries, metadata
+    return _QUERY_RE.findall(queries)[:n], metadata
+
+def search_batch(vectorstore: FAISS, queries: List[str], k: int = 4) -> List[List[Any]]:
+    """Same result as [retriever.invoke(q) for q in queries], but with one embedding request and one index.search"""
+    embed_array = getattr(vectorstore.embedding_function, "embed_documents_array", None)
+    if embed_array is not None:
+        vectors = embed_array(queries)  # already float32 and C-contiguous (fresh copy, safe to normalize)
+    else:
+        vectors = np.ascontiguousarray(vectorstore._embed_documents(queries), dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vectors)
+    _, indices = vectorstore.index.search(vectors, k)
+    return [
+        [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in row if i != -1]
+        for row in indices
+    ]
 
-def retrieve_documents(queries: List[str], retriever, fusion_fn, top_k: int):
-    # Each query: get docs, then fuse
-    results = [retriever.invoke(q) for q in queries]
-    fused = fusion_fn(results)
+def retrieve_documents(queries: List[str], retriever, fusion_fn, top_k: int,
+                       extra_results: Optional[List[List[Any]]] = None):
+    # All queries in one batch, then fuse (together with already retrieved extra_results, if any)
+    results = search_batch(retriever.vectorstore, queries, k=retriever.search_kwargs.get("k", 4))
+    fused = fusion_fn(results + (extra_results or []), top_n=top_k)
     return [doc for doc, _ in fused[:top_k]]
 
 def summarize_answer(query: str, documents: List[str], llm, chat_context: str = None) -> Tuple[str, Dict[str, Any]]:
     """Summarize answer and return both answer and metadata"""
-    chain = summary_prompt | llm | StrOutputParser()
+    chain = get_chain("summary", summary_prompt, llm)
     
     # Prepare chat context section for the prompt
     chat_context_section = ""
@@ -110,11 +185,13 @@ def rag_fusion_answer(
     num_generated_queries: int = 3,
     top_k: int = 3,
     params: Optional[dict] = None,
-    chat_context: Optional[str] = None
+    chat_context: Optional[str] = None,
+    vectorstore: Optional[FAISS] = None
 ) -> Tuple[str, dict]:
     """
     mode: 'original' | 'generated'
     chat_context: (Optional) Full conversation so far, to be given to LLM
+    vectorstore: (Optional) FAISS base already loaded at startup; otherwise loaded once from local_index_path and reused
     
     Returns:
         Tuple of (answer, metadata) where metadata includes:
@@ -126,8 +203,9 @@ def rag_fusion_answer(
         - num_documents_retrieved: Number of documents retrieved
     """
     llm = get_llm(params)
-    vectorstore = load_vectorstore(local_index_path, embedding_model)
-    retriever = vectorstore.as_retriever()
+    if vectorstore is None:
+        vectorstore = load_vectorstore(local_index_path, embedding_model)
+    retriever = get_retriever(vectorstore)
     
     # Initialize metadata
     metadata = {
@@ -148,25 +226,32 @@ def rag_fusion_answer(
         "num_documents_retrieved": 0
     }
     
+    original_results = None
     if mode == 'original':
         queries = [user_query]
         logger.info("Running in original query mode.")
     elif mode == 'generated':
+        # Retrieval for the original query overlaps with the query generation LLM call;
+        # its ranks are merged into RRF together with the generated queries
+        original_future = _executor.submit(
+            search_batch, vectorstore, [user_query], retriever.search_kwargs.get("k", 4)
+        )
         queries, query_gen_metadata = generate_queries(user_query, llm, num_generated_queries)
+        original_results = original_future.result()
         metadata["query_generation_usage"] = query_gen_metadata
         metadata["token_usage"]["total_tokens"] += query_gen_metadata["total_tokens"]
         metadata["token_usage"]["prompt_tokens"] += query_gen_metadata["prompt_tokens"]
         metadata["token_usage"]["completion_tokens"] += query_gen_metadata["completion_tokens"]
         metadata["token_usage"]["total_cost"] += query_gen_metadata["total_cost"]
         metadata["token_usage"]["successful_requests"] += query_gen_metadata["successful_requests"]
-        logger.info(f"Running in query generation mode with {num_generated_queries} queries: {queries}")
+        logger.info("Running in query generation mode with %s queries: %s", num_generated_queries, queries)
     else:
         raise ValueError(f"Invalid mode: {mode}")
     
     metadata["queries_used"] = queries
     
     # Retrieve documents
-    docs = retrieve_documents(queries, retriever, reciprocal_rank_fusion, top_k)
+    docs = retrieve_documents(queries, retriever, reciprocal_rank_fusion, top_k, extra_results=original_results)
     metadata["num_documents_retrieved"] = len(docs)
     
     # Extract document content
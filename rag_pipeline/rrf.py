@@ -0,0 +1,58 @@
+"""Reciprocal Rank Fusion над id документов FAISS (JIT через Numba, если установлена)"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba опциональна — без нее используется векторизованный numpy
+    njit = None
+
+
+def _rrf_scores_numpy(ids: np.ndarray, unique_ids: np.ndarray, k: float) -> np.ndarray:
+    ranks = np.broadcast_to(np.arange(ids.shape[1]), ids.shape)
+    mask = ids >= 0
+    positions = np.searchsorted(unique_ids, ids[mask])
+    return np.bincount(
+        positions,
+        weights=1.0 / (ranks[mask] + k),
+        minlength=unique_ids.shape[0]
+    ).astype(np.float32)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _rrf_scores(ids, unique_ids, k):
+        # Каждый поток считает score своих документов — без гонок на общем массиве
+        scores = np.zeros(unique_ids.shape[0], dtype=np.float32)
+        for u in prange(unique_ids.shape[0]):
+            doc_id = unique_ids[u]
+            score = np.float32(0.0)
+            for q in range(ids.shape[0]):
+                for rank in range(ids.shape[1]):
+                    if ids[q, rank] == doc_id:
+                        score += np.float32(1.0) / (rank + k)
+            scores[u] = score
+        return scores
+else:
+    _rrf_scores = _rrf_scores_numpy
+
+
+def rrf_fuse(ids: np.ndarray, k: int = 3, top_n: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    ids: (кол-во запросов, top_k) id документов FAISS по рангу, -1 — пустая позиция
+    top_n: сколько лучших документов вернуть (None — все)
+    Returns: (id документов по убыванию score, score)
+    """
+    ids = np.ascontiguousarray(np.atleast_2d(ids), dtype=np.int64)
+    unique_ids = np.unique(ids[ids >= 0])
+    scores = _rrf_scores(ids, unique_ids, np.float32(k))
+    # Стабильная сортировка: при равном score — меньший id первым (документов — единицы-десятки,
+    # а argpartition на границе top_n выбирает из равных произвольно)
+    order = np.argsort(-scores, kind="stable")[:top_n]
+    return unique_ids[order], scores[order]
+
+
+def warmup():
+    """Компиляция JIT на маленьком входе при старте, чтобы не задерживать первый запрос"""
+    rrf_fuse(np.array([[0, 1], [1, -1]], dtype=np.int64))
@@ -0,0 +1,48 @@
+"""Настройка загруженной базы FAISS под метрику ее индекса"""
+import logging
+import pickle
+from pathlib import Path
+
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+logger = logging.getLogger(__name__)
+
+
+def apply_index_metric(vectorstore: FAISS) -> FAISS:
+    """
+    LangChain не сохраняет distance_strategy и normalize_L2 в index.pkl, поэтому они берутся из самого индекса:
+    для индекса по скалярному произведению (IndexFlatIP и т.п.) векторы запросов и новых документов нормализуются,
+    и скалярное произведение равно косинусной близости
+    """
+    if vectorstore.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        vectorstore.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+        vectorstore._normalize_L2 = True
+    else:
+        # L2 по ненормализованным векторам не совпадает с косинусной близостью, с которой обучены эмбеддинги OpenAI
+        logger.warning("FAISS index uses L2 distance; rebuild it for cosine search with "
+                       "rag_pipeline/quantize_index.py --metric ip (e.g. --factory Flat or IVF256,PQ16)")
+    return vectorstore
+
+
+def load_vectorstore(path: str, embeddings, mmap: bool = True) -> FAISS:
+    """
+    Аналог FAISS.load_local для сервера: index.faiss отображается в память (mmap, только чтение) —
+    загрузка не копирует индекс в RAM, а воркеры uvicorn делят одну копию в page cache ОС.
+    Индексы, которые FAISS не умеет читать через mmap, загружаются обычным способом
+    """
+    path = Path(path)
+    index_file = str(path / "index.faiss")
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            logger.warning("FAISS index can't be memory-mapped, reading it into RAM: %s", e)
+    if index is None:
+        index = faiss.read_index(index_file)
+    # index.pkl создан нашими скриптами (add_doc.py / quantize_index.py) — как allow_dangerous_deserialization в LangChain
+    with open(path / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return apply_index_metric(FAISS(embeddings, index, docstore, index_to_docstore_id))
@@ -0,0 +1,30 @@
+from datetime import datetime
+from src.rag_chatbot.config.settings import settings
+
+HEALTH_PATHS = frozenset({"/health", "/api/v1/health", "/api/v1/health/"})
+
+class FastHealthMiddleware:
+    """ASGI middleware: ответ на liveness-проверки до CORS, роутинга и зависимостей FastAPI"""
+
+    def __init__(self, app):
+        self.app = app
+        # Ответ собирается заранее, на каждый запрос подставляется только время
+        self._body_prefix = b'{"status":"healthy","version":"' + settings.version.encode() + b'","timestamp":"'
+        self._headers = [(b"content-type", b"application/json")]
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["path"] not in HEALTH_PATHS
+                or scope["method"] not in ("GET", "HEAD")):
+            await self.app(scope, receive, send)
+            return
+
+        body = self._body_prefix + datetime.now().isoformat().encode() + b'"}'
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": self._headers + [(b"content-length", str(len(body)).encode())]
+        })
+        await send({
+            "type": "http.response.body",
+            "body": body if scope["method"] == "GET" else b""
+        })
@@ -1,15 +1,16 @@
 # src/rag_chatbot/api/routes/chat.py (Updated with Analytics)
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Request
-from langchain.schema import HumanMessage, AIMessage
-from langchain_openai import OpenAIEmbeddings
 from datetime import datetime
+import asyncio
+import functools
 import time
+import orjson
 
 from src.rag_chatbot.models.schemas import ChatMessage, ChatResponse
 from src.rag_chatbot.api.middleware.auth import get_api_key
 from src.rag_chatbot.utils.logger import logger
 from src.rag_chatbot.config.settings import settings
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, ORJSONResponse
 from src.rag_chatbot.core.instances import session_manager, rate_limiter, rag_pipeline
 from src.rag_chatbot.services.analytics_service import AnalyticsService
 from src.rag_chatbot.core.database import get_db
@@ -17,39 +18,115 @@ import os
 from pathlib import Path
 
 router = APIRouter()
-embedding_model = OpenAIEmbeddings(model=settings.embedding_model)
 
-@router.post("/", response_model=ChatResponse)
+def _sse(event: str, data: dict) -> str:
+    """Одно событие Server-Sent Events"""
+    payload = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY, default=str).decode()
+    return f"event: {event}\ndata: {payload}\n\n"
+
+async def _record_exchange(session_id, session, message, answer, meta, chat_context,
+                           response_time_ms, now, request, background_tasks, analytics):
+    """Обновление памяти и сессии после ответа, метаданные и трекинг аналитики"""
+    session_manager.add_exchange(session, message, answer)
+    
+    session["message_count"] += 1
+    session_manager.touch(session, now)
+    await session_manager.save_session(session_id, session)
+    
+    # Добавить контекст для метаданных
+    meta["chat_context_used"] = len(chat_context) > 0
+    meta["chat_context_length"] = len(chat_context)
+    meta["conversation_turn"] = session["message_count"]
+    meta["response_time_ms"] = response_time_ms
+    meta["user_agent"] = request.headers.get("user-agent")
+    meta["ip_address"] = request.client.host
+    
+    # Трекинг аналитики
+    background_tasks.add_task(
+        analytics.track_conversation,
+        session_id,
+        message,
+        answer,
+        meta,
+        response_time_ms
+    )
+
+async def _stream_chat(session_id, session, message, chat_context, start_time,
+                       request, background_tasks, analytics):
+    """SSE: события delta с частями ответа по мере генерации, в конце done с полями ChatResponse"""
+    loop = asyncio.get_running_loop()
+    events = rag_pipeline.get_response_stream(user_query=message, chat_context=chat_context)
+    answer, meta = "", {}
+    try:
+        while True:
+            # Каждый шаг генератора (LLM, FAISS) выполняется в пуле потоков
+            item = await loop.run_in_executor(request.app.state.executor, next, events, None)
+            if item is None:
+                break
+            event, payload = item
+            if event == "delta":
+                yield _sse("delta", {"text": payload})
+            else:
+                answer, meta = payload
+        
+        response_time_ms = (time.time() - start_time) * 1000
+        await _record_exchange(session_id, session, message, answer, meta, chat_context,
+                               response_time_ms, datetime.now(), request, background_tasks, analytics)
+        
+        yield _sse("done", {
+            "response": answer,
+            "session_id": session_id,
+            "message_count": session["message_count"],
+            "metadata": meta,
+            "timestamp": session["last_accessed_iso"],
+            "rate_limit": await rate_limiter.get_session_stats(session_id)
+        })
+    except Exception as e:
+        # Статус 200 уже отправлен — ошибка передается событием
+        logger.error("Chat streaming error: %s", e, exc_info=True)
+        background_tasks.add_task(analytics.track_error, session_id, "InternalError", str(e))
+        yield _sse("error", {"detail": "Internal server error"})
+    finally:
+        # Клиент отключился — закрыть генератор и поток OpenAI, чтобы соединение вернулось в общий пул
+        try:
+            await loop.run_in_executor(request.app.state.executor, events.close)
+        except ValueError:
+            # Шаг генератора еще выполняется в пуле (запрос отменен во время next) — закроется сборщиком мусора
+            pass
+
+@router.post("/", response_model=None, responses={200: {"model": ChatResponse}})
 async def chat(
     chat_request: ChatMessage,
     background_tasks: BackgroundTasks,
     request: Request,
+    stream: bool = False,
     credentials = Depends(get_api_key),
     db = Depends(get_db)
 ):
-    """Основной эндпоинт чата, включающий: - память чата - rate limiting  - отправкой файлов"""
+    """Основной эндпоинт чата, включающий: - память чата - rate limiting  - отправкой файлов
+    ?stream=true — ответ потоком SSE (документы PDF в этом режиме не отдаются файлом)"""
     start_time = time.time()
     analytics = AnalyticsService(db)
     
     try:
-        logger.info(f"Received chat request: {chat_request.message}")
+        logger.debug("Received chat request: %s", chat_request.message)
         
         # Создание или получение сессии 
         if chat_request.session_id:
-            session = session_manager.get_session(chat_request.session_id)
+            session = await session_manager.get_session(chat_request.session_id)
             if not session:
                 raise HTTPException(status_code=404, detail="Session not found or expired")
             session_id = chat_request.session_id
         else:
-            session_id = session_manager.create_session()
-            session = session_manager.get_session(session_id)
+            session_id = await session_manager.create_session()
+            session = await session_manager.get_session(session_id)
         
         # Проверка Лимита
-        is_allowed, retry_after = rate_limiter.is_allowed(session_id)
-        rate_limit_stats = rate_limiter.get_session_stats(session_id)
+        is_allowed, retry_after = await rate_limiter.is_allowed(session_id)
+        rate_limit_stats = await rate_limiter.get_session_stats(session_id)
         
         if not is_allowed:
-            logger.warning(f"Rate limit exceeded for session {session_id}")
+            logger.warning("Rate limit exceeded for session %s", session_id)
             
             # Трекинг лимита для аналитики
             analytics.track_rate_limit(session_id, retry_after)
@@ -63,39 +140,38 @@ async def chat(
                 }
             )
         
-        # Получение предыдущего разговора и создание контекста для промпта на основе истории 
-        memory = session["memory"]
-        conversation_history = memory.chat_memory.messages
-        context_messages = []
-        
-        # Форматирование разговора для добавление в промпт
-        for msg in conversation_history:
-            if isinstance(msg, HumanMessage):
-                context_messages.append(f"User: {msg.content}")
-            elif isinstance(msg, AIMessage):
-                context_messages.append(f"Zaure: {msg.content}")
-        
-        # Ограничение последними N обменами для контекста (чтобы избежать ограничения по токенам)
-        max_history = settings.max_memory_length
-        if context_messages:
-            recent_messages = context_messages[-max_history:] if len(context_messages) > max_history else context_messages
-            chat_context = "\n".join(recent_messages)
-            logger.info(f"Using {len(recent_messages)} messages for context")
+        # Контекст для промпта на основе истории: сессия хранит уже отформатированные
+        # последние N сообщений (чтобы избежать ограничения по токенам)
+        context_lines = session_manager.get_context_lines(session)
+        if context_lines:
+            chat_context = "\n".join(context_lines)
+            logger.debug("Using %s messages for context", len(context_lines))
         else:
             chat_context = ""
-            logger.info("No previous conversation history")
+            logger.debug("No previous conversation history")
         
         # Получение ответа от LLM для контекста
-        logger.info(f"Processing query for session {session_id}: {chat_request.message}")
-        logger.info(f"Chat context length: {len(chat_context)} characters")
+        logger.info("Processing query for session %s: %s", session_id, chat_request.message)
+        logger.debug("Chat context length: %s characters", len(chat_context))
+        
+        if stream:
+            return StreamingResponse(
+                _stream_chat(session_id, session, chat_request.message, chat_context, start_time,
+                             request, background_tasks, analytics),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Session-ID": session_id}
+            )
         
-        # Обработка запроса с помощью RAG + OpenAI
-        answer, meta = rag_pipeline.get_response(
-            user_query=chat_request.message
+        # Обработка запроса с помощью RAG + OpenAI (в пуле потоков, чтобы не блокировать event loop)
+        answer, meta = await asyncio.get_running_loop().run_in_executor(
+            request.app.state.executor,
+            functools.partial(rag_pipeline.get_response, user_query=chat_request.message,
+                              chat_context=chat_context, mode=chat_request.mode)
         )
         
         # Calculate response time
         response_time_ms = (time.time() - start_time) * 1000
+        now = datetime.now()  # одно время на весь ответ
         
         # пайплайн для получения документов—проверка если система решила достать документ и проверка есть ли он 
         if (meta.get("decision") == "retrieve_document" and 
@@ -108,15 +184,19 @@ async def chat(
             if os.path.exists(file_path) and os.path.isfile(file_path):
                 file_extension = Path(file_path).suffix.lower()
                 if file_extension == '.pdf':
-                    logger.info(f"Returning PDF file: {file_path}")
+                    logger.info("Returning PDF file: %s", file_path)
                     
                     # обновление памяти чата
-                    memory.chat_memory.add_user_message(chat_request.message)
-                    memory.chat_memory.add_ai_message(f"Retrieved document: {meta.get('document_name', 'Unknown')}")
+                    session_manager.add_exchange(
+                        session,
+                        chat_request.message,
+                        f"Retrieved document: {meta.get('document_name', 'Unknown')}"
+                    )
                     
                     # обновление сессии
                     session["message_count"] += 1
-                    session["last_accessed"] = datetime.now()
+                    session_manager.touch(session, now)
+                    await session_manager.save_session(session_id, session)
                     
                     # трекинг аналитики
                     background_tasks.add_task(
@@ -165,52 +245,30 @@ async def chat(
                         headers=safe_headers
                     )
                 else:
-                    logger.warning(f"File is not a PDF: {file_path} (extension: {file_extension})")
+                    logger.warning("File is not a PDF: %s (extension: %s)", file_path, file_extension)
             else:
-                logger.warning(f"File does not exist or is not readable: {file_path}")
+                logger.warning("File does not exist or is not readable: %s", file_path)
 
         # Обычный ответ (без документа)
-        # Обновление памяти после получения разговора 
-        memory.chat_memory.add_user_message(chat_request.message)
-        memory.chat_memory.add_ai_message(answer)
-        
-        
-        session["message_count"] += 1
-        session["last_accessed"] = datetime.now()
-        
-        # Добавить контекст для метаданных
-        meta["chat_context_used"] = len(chat_context) > 0
-        meta["chat_context_length"] = len(chat_context)
-        meta["conversation_turn"] = session["message_count"]
-        meta["response_time_ms"] = response_time_ms
-        meta["user_agent"] = request.headers.get("user-agent")
-        meta["ip_address"] = request.client.host
-        
-        # Трекинг аналитики
-        background_tasks.add_task(
-            analytics.track_conversation,
-            session_id,
-            chat_request.message,
-            answer,
-            meta,
-            response_time_ms
-        )
+        # Обновление памяти после получения разговора, трекинг аналитики
+        await _record_exchange(session_id, session, chat_request.message, answer, meta, chat_context,
+                               response_time_ms, now, request, background_tasks, analytics)
         
         # Обновление rate limit 
-        updated_rate_limit_stats = rate_limiter.get_session_stats(session_id)
+        updated_rate_limit_stats = await rate_limiter.get_session_stats(session_id)
         
-        # Ответ
-        response = ChatResponse(
+        # Ответ (поля заполнены сервером — схема только для документации, без валидации)
+        response = ChatResponse.model_construct(
             response=answer,
             session_id=session_id,
             message_count=session["message_count"],
             metadata=meta,
-            timestamp=datetime.now().isoformat(),
+            timestamp=session["last_accessed_iso"],
             rate_limit=updated_rate_limit_stats
         )
         
-        logger.info(f"Successfully processed query for session {session_id}")
-        return response
+        logger.info("Successfully processed query for session %s", session_id)
+        return ORJSONResponse(response.model_dump())
         
     except HTTPException:
         # Трекинг аналитики для HTTP ошибок
@@ -223,7 +281,7 @@ async def chat(
             )
         raise
     except Exception as e:
-        logger.error(f"Chat processing error: {str(e)}", exc_info=True)
+        logger.error("Chat processing error: %s", e, exc_info=True)
         
         # Трекинг аналитики ошибок
         if 'session_id' in locals():
@@ -248,5 +306,5 @@ async def get_analytics_dashboard(
         dashboard_data = analytics.get_dashboard_data(hours=hours)
         return dashboard_data
     except Exception as e:
-        logger.error(f"Error fetching dashboard data: {str(e)}")
+        logger.error("Error fetching dashboard data: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch analytics data")
\ No newline at end of file
@@ -1,6 +1,5 @@
 # src/rag_chatbot/api/routes/chat.py
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
-from langchain.schema import HumanMessage, AIMessage
 from langchain_openai import OpenAIEmbeddings
 from datetime import datetime
 
@@ -38,17 +37,17 @@ async def chat(
         
         # Создание или получение сессии 
         if chat_request.session_id:
-            session = session_manager.get_session(chat_request.session_id)
+            session = await session_manager.get_session(chat_request.session_id)
             if not session:
                 raise HTTPException(status_code=404, detail="Session not found or expired")
             session_id = chat_request.session_id
         else:
-            session_id = session_manager.create_session()
-            session = session_manager.get_session(session_id)
+            session_id = await session_manager.create_session()
+            session = await session_manager.get_session(session_id)
         
         # Проверка Лимита
-        is_allowed, retry_after = rate_limiter.is_allowed(session_id)
-        rate_limit_stats = rate_limiter.get_session_stats(session_id)
+        is_allowed, retry_after = await rate_limiter.is_allowed(session_id)
+        rate_limit_stats = await rate_limiter.get_session_stats(session_id)
         
         if not is_allowed:
             logger.warning(f"Rate limit exceeded for session {session_id}")
@@ -61,22 +60,10 @@ async def chat(
                 }
             )
         
-        # Получение предыдущего разговора и создание контекста для промпта на основе истории 
-        memory = session["memory"]
-        conversation_history = memory.chat_memory.messages
-        context_messages = []
-        
-        # Форматирование разговора для добавление в промпт
-        for msg in conversation_history:
-            if isinstance(msg, HumanMessage):
-                context_messages.append(f"User: {msg.content}")
-            elif isinstance(msg, AIMessage):
-                context_messages.append(f"AI-assistent : {msg.content}")
-        
-        # Ограничение последними N обменами для контекста (чтобы избежать ограничения по токенам)
-        max_history = settings.max_memory_length
-        if context_messages:
-            recent_messages = context_messages[-max_history:] if len(context_messages) > max_history else context_messages
+        # Контекст для промпта на основе истории: сессия хранит уже отформатированные
+        # последние N сообщений (чтобы избежать ограничения по токенам)
+        recent_messages = session_manager.get_context_lines(session)
+        if recent_messages:
             chat_context = "\n".join(recent_messages)
             logger.info(f"Using {len(recent_messages)} messages for context")
         else:
@@ -105,12 +92,16 @@ async def chat(
                     logger.info(f"Returning PDF file: {file_path}")
                     
                     # обновление памяти чата
-                    memory.chat_memory.add_user_message(chat_request.message)
-                    memory.chat_memory.add_ai_message(f"Retrieved document: {meta.get('document_name', 'Unknown')}")
+                    session_manager.add_exchange(
+                        session,
+                        chat_request.message,
+                        f"Retrieved document: {meta.get('document_name', 'Unknown')}"
+                    )
                     
                     # обновление сессии
                     session["message_count"] += 1
-                    session["last_accessed"] = datetime.now()
+                    session_manager.touch(session)
+                    await session_manager.save_session(session_id, session)
                     
                     # Безопасное кодирование метаданных для заголовков (HTTP-заголовки должны быть в кодировке Latin-1)
                     def safe_encode_header(value: str) -> str:
@@ -147,11 +138,11 @@ async def chat(
         
         # Обычный ответ (без документа)
         # Обновление памяти после получения разговора 
-        memory.chat_memory.add_user_message(chat_request.message)
-        memory.chat_memory.add_ai_message(answer)
+        session_manager.add_exchange(session, chat_request.message, answer)
         
         session["message_count"] += 1
-        session["last_accessed"] = datetime.now()
+        session_manager.touch(session)
+        await session_manager.save_session(session_id, session)
         
         # Добавить контекст для метаданных
         meta["chat_context_used"] = len(chat_context) > 0
@@ -159,7 +150,7 @@ async def chat(
         meta["conversation_turn"] = session["message_count"]
         
         # Обновление rate limit 
-        updated_rate_limit_stats = rate_limiter.get_session_stats(session_id)
+        updated_rate_limit_stats = await rate_limiter.get_session_stats(session_id)
         
         # Подготовка ответа
         response = ChatResponse(
@@ -1,19 +1,46 @@
 # src/rag_chatbot/api/routes/sessions.py
 # Работа с сессией
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from datetime import datetime
-from langchain.schema import HumanMessage, AIMessage
+import orjson
 from src.rag_chatbot.models.schemas import SessionCreateResponse, SessionStatsResponse
 from src.rag_chatbot.api.middleware.auth import get_api_key
 from src.rag_chatbot.config.settings import settings
 from src.rag_chatbot.core.instances import session_manager, rate_limiter
+from src.rag_chatbot.core.session_manager import USER_PREFIX, AI_PREFIX
 
 router = APIRouter()
 
+HISTORY_CHUNK_BYTES = 64 * 1024 # размер части ответа истории
+
+def _stream_history(session_id: str, session: dict, rate_limit_stats: dict):
+    """JSON истории по частям: сообщения кодируются по одному, без промежуточного списка"""
+    # Снимок ссылок на сообщения — память сессии может измениться во время отправки
+    messages = tuple(session["history"])
+    now = datetime.now()
+    
+    # Сообщения копятся в буфер и отправляются частями ~64 КБ, а не отдельным send на каждое
+    buffer = bytearray(b'{"session_id":' + orjson.dumps(session_id) + b',"message_count":' + orjson.dumps(session["message_count"]) + b',"messages":[')
+    for i, line in enumerate(messages):
+        if i:
+            buffer += b","
+        is_user = line.startswith(USER_PREFIX)
+        buffer += orjson.dumps({
+            "type": "human" if is_user else "ai",
+            "content": line[len(USER_PREFIX):] if is_user else line[len(AI_PREFIX):],
+            "timestamp": now
+        })
+        if len(buffer) >= HISTORY_CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b'],"rate_limit":' + orjson.dumps(rate_limit_stats) + b"}"
+    yield bytes(buffer)
+
 @router.post("/", response_model=SessionCreateResponse)
 async def create_session(credentials = Depends(get_api_key)):
     """Создание новой сессии"""
-    session_id = session_manager.create_session()
+    session_id = await session_manager.create_session()
     return SessionCreateResponse(
         session_id=session_id,
         created_at=datetime.now().isoformat()
@@ -22,7 +49,7 @@ async def create_session(credentials = Depends(get_api_key)):
 @router.delete("/{session_id}")
 async def delete_session(session_id: str, credentials = Depends(get_api_key)):
     """Удаление сессии"""
-    success = session_manager.delete_session(session_id)
+    success = await session_manager.delete_session(session_id)
     if not success:
         raise HTTPException(status_code=404, detail="Session not found")
     return {"message": "Session deleted successfully"}
@@ -30,41 +57,31 @@ async def delete_session(session_id: str, credentials = Depends(get_api_key)):
 @router.get("/{session_id}/history")
 async def get_conversation_history(session_id: str, credentials = Depends(get_api_key)):
     """Получение истории разговора в сессии"""
-    session = session_manager.get_session(session_id)
+    session = await session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found or expired")
     
-    messages = []
-    for msg in session["memory"].chat_memory.messages:
-        messages.append({
-            "type": "human" if isinstance(msg, HumanMessage) else "ai",
-            "content": msg.content,
-            "timestamp": datetime.now()
-        })
+    rate_limit_stats = await rate_limiter.get_session_stats(session_id)
     
-    rate_limit_stats = rate_limiter.get_session_stats(session_id)
-    
-    return {
-        "session_id": session_id,
-        "message_count": session["message_count"],
-        "messages": messages,
-        "rate_limit": rate_limit_stats
-    }
+    return StreamingResponse(
+        _stream_history(session_id, session, rate_limit_stats),
+        media_type="application/json"
+    )
 
-@router.get("/stats", response_model=SessionStatsResponse)
+# Схема только для документации: словарь статистики отдается напрямую в orjson без повторной валидации
+@router.get("/stats", response_model=None, responses={200: {"model": SessionStatsResponse}})
 async def get_session_stats(credentials = Depends(get_api_key)):
     """Получение статистики"""
-    stats = session_manager.get_session_stats()
-    return SessionStatsResponse(**stats)
+    return session_manager.get_session_stats()
 
 @router.get("/{session_id}/rate-limit")
 async def get_rate_limit_stats(session_id: str, credentials = Depends(get_api_key)):
     """Лимит для сессии"""
-    session = session_manager.get_session(session_id)
+    session = await session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found or expired")
     
-    rate_stats = rate_limiter.get_session_stats(session_id)
+    rate_stats = await rate_limiter.get_session_stats(session_id)
     return {
         "session_id": session_id,
         "rate_limit": rate_stats
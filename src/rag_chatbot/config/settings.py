@@ -7,25 +7,58 @@ class Settings(BaseSettings):
     app_name: str = "RAG Chatbot"
     version: str = "1.0.0"
     api_key: str = ""
+
+    # Server settings (для запуска через python -m src.rag_chatbot.main)
+    host: str = "0.0.0.0"
+    port: int = 8000
+    workers: int = 1 # кол-во процессов uvicorn; при > 1 задать REDIS_URL, чтобы сессии были общими
+    debug: bool = False # автоперезагрузка (только с одним воркером)
+    log_level: str = "INFO" # в продакшне WARNING — запросы пользователей не логируются
     
     embedding_model: str = "text-embedding-3-large-"
+    embedding_cache_size: int = 10000 # кол-во эмбеддингов запросов в LRU-кэше
 
     # LLM settings
     llm_type: str = "OpenAI"
     openai_api_key: str = ""
     llm_params: str = ""
 
+    # HTTP client settings (общий пул соединений к OpenAI)
+    http_max_connections: int = 256
+    http_max_keepalive_connections: int = 128
+    http_timeout_seconds: float = 60
+    http_keepalive_expiry_seconds: float = 60 # сколько держать простаивающее соединение
+    http2: bool = True # мультиплексирование запросов в одном соединении (пакет h2)
+    http_retries: int = 2 # повторы при ошибке установки соединения
+
     # Vector database settings
     vector_store_path: str = "./data/faiss_index"
     document_json_path: str = "./data/documents.json"
     document_embeddings_path: str = "./data/document_embeddings.npy"
+    faiss_mmap: bool = True # индекс FAISS отображается в память (общий для воркеров), а не копируется в RAM
+    faiss_omp_threads: int = 0 # кол-во потоков OpenMP для FAISS (0 — по умолчанию, все ядра)
+    faiss_nprobe: int = 16 # кол-во просматриваемых кластеров для IVF-индексов (см. rag_pipeline/quantize_index.py)
+    faiss_ef_search: int = 64 # ширина поиска для HNSW-индексов
+    search_batch_max_size: int = 32 # макс. кол-во векторов в одном батче поиска FAISS
+    search_batch_max_wait_ms: int = 10 # сколько ждать другие запросы перед поиском
+    rag_executor_workers: int = 0 # потоки для выполнения RAG-пайплайна вне event loop (0 — min(32, cpu*4))
+
+    # Answer cache settings
+    answer_cache_size: int = 1024 # кол-во кэшированных ответов (0 — кэш отключен)
+    answer_cache_ttl_seconds: int = 600 # время жизни ответа в кэше
+    answer_cache_similarity: float = 0.97 # порог косинусной близости для семантического кэша (0 — только точное совпадение)
+    answer_cache_semantic_size: int = 256 # кол-во недавних запросов для семантического поиска
 
     # memory settings
     memory_window_size: int = 5 # кол-во сообщений, используемых для контекста истории переписки 
 
     # Chatbot settings
     session_timeout_minutes: int = 30
+    max_sessions: int = 10000 # максимальное кол-во сессий в памяти воркера (LRU)
+    session_shards: int = 16 # кол-во шардов (со своим lock) для хранения сессий
+    redis_url: str = "" # если задан, сессии и rate limit хранятся в Redis и общие для всех воркеров
     max_memory_length: int = 10 # максимальное кол-во сообщений, используемых для контекста
+    context_token_budget: int = 800 # макс. кол-во токенов истории в контексте (0 — без ограничения)
     rate_limit_requests: int = 5
     rate_limit_window_minutes: int = 1
     
@@ -0,0 +1,80 @@
+# src/rag_chatbot/core/answer_cache.py
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+from src.rag_chatbot.core.embeddings import CachedEmbeddings
+
+class AnswerCache:
+    """
+    Кэш ответов RAG в два уровня:
+    1. точное совпадение (запрос, режим, контекст диалога)
+    2. семантическое — косинусная близость эмбеддинга запроса к недавним запросам с тем же контекстом
+    """
+
+    def __init__(self, embeddings: CachedEmbeddings, maxsize: int = 1024, ttl_seconds: float = 600,
+                 similarity_threshold: float = 0.97, semantic_size: int = 256):
+        self.embeddings = embeddings
+        self.exact: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl_seconds)
+        self.similarity_threshold = similarity_threshold
+        self.semantic_size = semantic_size
+        # Кольцевой буфер недавних запросов: нормализованные эмбеддинги, хэш контекста и ключ точного уровня
+        self._vectors: Optional[np.ndarray] = None
+        self._context_hashes = np.zeros(semantic_size, dtype=np.int64)
+        self._keys: list = [None] * semantic_size
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query: str, mode: str, chat_context: str) -> Tuple[str, str, int]:
+        return " ".join(query.split()), mode, hash(chat_context)
+
+    def _embed(self, query: str) -> np.ndarray:
+        vector = self.embeddings.embed_query_array(query)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, query: str, mode: str, chat_context: str) -> Optional[Tuple[str, Dict[str, Any], str]]:
+        """Returns: (answer, metadata, уровень: "exact" | "semantic") или None"""
+        key = self._key(query, mode, chat_context)
+        with self._lock:
+            cached = self.exact.get(key)
+        if cached is not None:
+            return cached[0], cached[1], "exact"
+
+        if self.similarity_threshold <= 0:
+            return None
+        with self._lock:
+            n = min(self._count, self.semantic_size)
+            # Нет недавних запросов с этим контекстом — эмбеддинг запроса не нужен
+            if not (self._context_hashes[:n] == key[2]).any():
+                return None
+
+        vector = self._embed(query)
+        with self._lock:
+            n = min(self._count, self.semantic_size)
+            # Одно матрично-векторное произведение по недавним запросам; другой контекст не подходит
+            scores = self._vectors[:n] @ vector
+            scores[self._context_hashes[:n] != key[2]] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+            cached = self.exact.get(self._keys[best])
+        if cached is None:
+            return None
+        return cached[0], cached[1], "semantic"
+
+    def put(self, query: str, mode: str, chat_context: str, answer: str, metadata: Dict[str, Any]):
+        key = self._key(query, mode, chat_context)
+        vector = self._embed(query) if self.similarity_threshold > 0 else None
+        with self._lock:
+            self.exact[key] = (answer, metadata)
+            if vector is None:
+                return
+            if self._vectors is None:
+                self._vectors = np.zeros((self.semantic_size, vector.shape[0]), dtype=np.float32)
+            slot = self._count % self.semantic_size
+            self._vectors[slot] = vector
+            self._context_hashes[slot] = key[2]
+            self._keys[slot] = key
+            self._count += 1
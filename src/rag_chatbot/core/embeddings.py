@@ -0,0 +1,85 @@
+# src/rag_chatbot/core/embeddings.py
+import threading
+from typing import List, Tuple
+import numpy as np
+from cachetools import LRUCache
+from langchain_core.embeddings import Embeddings
+
+class CachedEmbeddings(Embeddings):
+    """Эмбеддинги с LRU-кэшем: повторные вопросы и сгенерированные подзапросы не отправляются в OpenAI"""
+
+    def __init__(self, embeddings: Embeddings, maxsize: int = 10000):
+        self.embeddings = embeddings
+        self.cache: LRUCache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str) -> str:
+        # Нормализация пробелов: "вопрос  " и "вопрос" — один ключ
+        return " ".join(text.split())
+
+    def _get(self, key: str):
+        with self._lock:
+            return self.cache.get(key)
+
+    @staticmethod
+    def _pin(vector: List[float]) -> np.ndarray:
+        # В кэше хранится float32 C-contiguous массив только для чтения:
+        # FAISS принимает его без повторного приведения типа, а общий для потоков вектор нельзя испортить
+        array = np.ascontiguousarray(vector, dtype=np.float32)
+        array.flags.writeable = False
+        return array
+
+    def _put(self, key: str, vector: List[float]) -> np.ndarray:
+        array = self._pin(vector)
+        with self._lock:
+            self.cache[key] = array
+        return array
+
+    def embed_query_array(self, text: str) -> np.ndarray:
+        """Эмбеддинг запроса как float32 массив (d,) — для поиска FAISS без конвертации из list"""
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = self._put(key, self.embeddings.embed_query(text))
+        return vector
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_query_array(text).tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = self._put(key, await self.embeddings.aembed_query(text))
+        return vector.tolist()
+
+    def _split(self, texts: List[str]) -> Tuple[List[str], List, List[int]]:
+        """Ключи, найденные в кэше векторы (None — промах) и индексы промахов"""
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            vectors = [self.cache.get(key) for key in keys]
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        return keys, vectors, misses
+
+    def _fill(self, keys: List[str], vectors: List, misses: List[int], computed: List[List[float]]):
+        with self._lock:
+            for i, vector in zip(misses, computed):
+                vectors[i] = self.cache[keys[i]] = self._pin(vector)
+
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Эмбеддинги как один float32 массив (n, d), готовый для index.search"""
+        # В OpenAI отправляются только промахи, одним батчем; результаты встают на свои места
+        keys, vectors, misses = self._split(texts)
+        if misses:
+            self._fill(keys, vectors, misses, self.embeddings.embed_documents([texts[i] for i in misses]))
+        return np.vstack(vectors)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents_array(texts).tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, misses = self._split(texts)
+        if misses:
+            self._fill(keys, vectors, misses, await self.embeddings.aembed_documents([texts[i] for i in misses]))
+        return [vector.tolist() for vector in vectors]
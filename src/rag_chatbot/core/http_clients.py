@@ -0,0 +1,26 @@
+# src/rag_chatbot/core/http_clients.py
+# Общие HTTP-клиенты для OpenAI (LLM и эмбеддинги): один пул keep-alive соединений на процесс
+import httpx
+from src.rag_chatbot.config.settings import settings
+
+http_limits = httpx.Limits(
+    max_connections=settings.http_max_connections,
+    max_keepalive_connections=settings.http_max_keepalive_connections,
+    keepalive_expiry=settings.http_keepalive_expiry_seconds
+)
+
+# HTTP/2: параллельные запросы к OpenAI мультиплексируются в одном TLS-соединении.
+# При явном transport лимиты и http2 задаются на нем (параметры клиента игнорируются)
+http_client = httpx.Client(
+    transport=httpx.HTTPTransport(http2=settings.http2, limits=http_limits, retries=settings.http_retries),
+    timeout=settings.http_timeout_seconds
+)
+async_http_client = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(http2=settings.http2, limits=http_limits, retries=settings.http_retries),
+    timeout=settings.http_timeout_seconds
+)
+
+async def close_http_clients():
+    """Закрытие пулов соединений при остановке приложения"""
+    http_client.close()
+    await async_http_client.aclose()
@@ -1,20 +1,32 @@
 from src.rag_chatbot.core.session_manager import SessionManager
 from src.rag_chatbot.core.rate_limiter import RateLimiter
 from src.rag_chatbot.core.rag_pipeline import RAGPipeline
+from src.rag_chatbot.core.search_batcher import SearchBatcher
 from src.rag_chatbot.config.settings import settings
 from src.rag_chatbot.tasks.analytics_tasks import AnalyticsTaskManager
 
 # Создание объектов
 session_manager = SessionManager(
     session_timeout_minutes=settings.session_timeout_minutes,
-    max_memory_length=settings.max_memory_length
+    max_memory_length=settings.max_memory_length,
+    max_sessions=settings.max_sessions,
+    redis_url=settings.redis_url,
+    shards=settings.session_shards,
+    context_token_budget=settings.context_token_budget
 )
 
+# Лимиты хранятся в том же Redis, что и сессии (один пул соединений), если он задан
 rate_limiter = RateLimiter(
     max_requests=settings.rate_limit_requests,
-    time_window_minutes=settings.rate_limit_window_minutes
+    time_window_minutes=settings.rate_limit_window_minutes,
+    redis=session_manager.redis
 )
 
-rag_pipeline = RAGPipeline()
+search_batcher = SearchBatcher(
+    max_batch_size=settings.search_batch_max_size,
+    max_wait_ms=settings.search_batch_max_wait_ms
+)
+
+rag_pipeline = RAGPipeline(search_batcher=search_batcher)
 
 analytics_task_manager = AnalyticsTaskManager()
\ No newline at end of file
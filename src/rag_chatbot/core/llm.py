@@ -1,9 +1,10 @@
 # file used to setup llm connections
 from src.rag_chatbot.config.settings import settings
+from src.rag_chatbot.core.http_clients import http_client, async_http_client
 import json
 
 if settings.llm_type == "OpenAI":
     from langchain_openai import ChatOpenAI
     params = json.loads(settings.llm_params)
-    llm = ChatOpenAI(**params)
+    llm = ChatOpenAI(**params, http_client=http_client, http_async_client=async_http_client)
     print("Finished!")
\ No newline at end of file
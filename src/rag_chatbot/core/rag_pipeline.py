@@ -1,17 +1,82 @@
 from rag_pipeline.rag_fusion_pipeline import rag_fusion_answer
 from rag_pipeline.agent import *
+from rag_pipeline.vectorstore import load_vectorstore
 from langchain_openai import OpenAIEmbeddings
 from src.rag_chatbot.config.settings import settings
+from src.rag_chatbot.core.http_clients import http_client, async_http_client
+from src.rag_chatbot.core.embeddings import CachedEmbeddings
+from src.rag_chatbot.core.answer_cache import AnswerCache
+from src.rag_chatbot.utils.logger import logger
 
 class RAGPipeline:
-    def __init__(self):
+    def __init__(self, search_batcher=None):
+        embedding_model = CachedEmbeddings(
+            OpenAIEmbeddings(
+                model=settings.embedding_model,
+                http_client=http_client,
+                http_async_client=async_http_client),
+            maxsize=settings.embedding_cache_size)
+
+        if settings.faiss_omp_threads > 0:
+            faiss.omp_set_num_threads(settings.faiss_omp_threads)
+
+        # База FAISS загружается один раз при старте; поиск по ней потокобезопасен,
+        # поэтому один экземпляр используется всеми запросами
+        self.vectorstore = load_vectorstore(
+            settings.vector_store_path,
+            embedding_model,
+            mmap=settings.faiss_mmap)
+        logger.info(f"Loaded FAISS index with {self.vectorstore.index.ntotal} vectors")
+        
+        # Для квантованных IVF-индексов (IVFPQ и т.п.) — точность/скорость поиска
+        ivf_index = faiss.try_extract_index_ivf(self.vectorstore.index)
+        if ivf_index is not None:
+            ivf_index.nprobe = settings.faiss_nprobe
+        # Для HNSW — ширина обхода графа
+        index = faiss.downcast_index(self.vectorstore.index)
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = settings.faiss_ef_search
+
         self.agent = create_unified_rag_agent(
             local_index_path = settings.vector_store_path,
-            embedding_model = OpenAIEmbeddings(model=settings.embedding_model),
+            embedding_model = embedding_model,
             documents_json_path = settings.document_json_path,
             memory_window_size = settings.memory_window_size,
-            document_embeddings_path=settings.document_embeddings_path)
+            document_embeddings_path=settings.document_embeddings_path,
+            search_batcher=search_batcher,
+            vectorstore=self.vectorstore)
+
+        # Кэш готовых ответов: повторные и почти одинаковые вопросы не идут в LLM
+        self.answer_cache = None
+        if settings.answer_cache_size > 0:
+            self.answer_cache = AnswerCache(
+                embedding_model,
+                maxsize=settings.answer_cache_size,
+                ttl_seconds=settings.answer_cache_ttl_seconds,
+                similarity_threshold=settings.answer_cache_similarity,
+                semantic_size=settings.answer_cache_semantic_size)
     
     def get_response(self, user_query: str, chat_context: str = "", mode: str = "generated"):
-        return  self.agent.process_query(user_query)
-    
\ No newline at end of file
+        """
+        Ответ агента с кэшем готовых ответов.
+        Агент отвечает по chat_context сессии, поэтому он же — ключ кэша;
+        ответ из кэша записывается в память агента, как и ответ агента.
+        """
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get(user_query, mode, chat_context)
+            if cached is not None:
+                answer, meta, level = cached
+                logger.info("Answer cache hit (%s)", level)
+                self.agent.record_exchange(user_query, answer)
+                # Копия метаданных — роут дополняет их полями конкретного запроса
+                return answer, {**meta, "cache_hit": level}
+
+        answer, meta = self.agent.process_query(user_query, context=chat_context)
+        if self.answer_cache is not None and meta.get("success"):
+            self.answer_cache.put(user_query, mode, chat_context, answer, dict(meta))
+        return answer, meta
+    
+    def get_response_stream(self, user_query: str, chat_context: str = ""):
+        """Генератор событий ("delta", текст) ... ("done", (answer, meta)) для SSE"""
+        return self.agent.process_query_stream(user_query, context=chat_context)
+    
@@ -1,35 +1,67 @@
 
-from datetime import datetime, timedelta
+import time
 from typing import Dict, Optional
 from collections import deque
 from src.rag_chatbot.utils.logger import logger
 
+# Атомарная проверка в Redis: счетчик запросов окна с TTL; отклоненный запрос не учитывается
+# Returns: {разрешено (1/0), запросов в окне, мс до сброса}
+_REDIS_ACQUIRE = """
+local n = redis.call('INCR', KEYS[1])
+if n == 1 then redis.call('PEXPIRE', KEYS[1], ARGV[1]) end
+local allowed = 1
+if n > tonumber(ARGV[2]) then
+    n = redis.call('DECR', KEYS[1])
+    allowed = 0
+end
+return {allowed, n, redis.call('PTTL', KEYS[1])}
+"""
+
 class RateLimiter:
-    """Ограничитель для отслеживания частоты сообщений на сессию"""
+    """Ограничитель для отслеживания частоты сообщений на сессию.
+    В памяти — скользящее окно на процесс; с Redis — фиксированное окно, общее для всех воркеров"""
     
-    def __init__(self, max_requests: int = 5, time_window_minutes: int = 1):
+    def __init__(self, max_requests: int = 5, time_window_minutes: int = 1, redis=None):
         self.max_requests = max_requests
-        self.time_window = timedelta(minutes=time_window_minutes)
+        self.time_window = time_window_minutes * 60.0 # секунды
+        # Время запросов — time.monotonic() в кольцевом буфере на max_requests значений
         self.request_history: Dict[str, deque] = {}
+        # Клиент redis.asyncio (общий пул с SessionManager)
+        self.redis = redis
+        self._redis_acquire = redis.register_script(_REDIS_ACQUIRE) if redis is not None else None
+
+    @staticmethod
+    def _redis_key(session_id: str) -> str:
+        return f"ratelimit:{session_id}"
     
-    def is_allowed(self, session_id: str) -> tuple[bool, Optional[float]]:
+    def _window(self, session_id: str, now: float) -> Optional[deque]:
+        """Запросы сессии в текущем окне (старые удаляются из начала буфера)"""
+        session_requests = self.request_history.get(session_id)
+        if session_requests is not None:
+            cutoff_time = now - self.time_window
+            while session_requests and session_requests[0] < cutoff_time:
+                session_requests.popleft()
+        return session_requests
+    
+    async def is_allowed(self, session_id: str) -> tuple[bool, Optional[float]]:
         """
         Проверяет можно ли отправлять сообщение
         Input: session_id — id сессии
         Returns: (is_allowed, seconds_until_reset)
         """
-        current_time = datetime.now()
+        if self.redis is not None:
+            allowed, _, ttl_ms = await self._redis_acquire(
+                keys=[self._redis_key(session_id)],
+                args=[int(self.time_window * 1000), self.max_requests]
+            )
+            return (True, None) if allowed else (False, max(0, ttl_ms) / 1000)
+
+        current_time = time.monotonic()
         
         # Создает сессию если её не было 
-        if session_id not in self.request_history:
-            self.request_history[session_id] = deque()
-        
-        session_requests = self.request_history[session_id]
-        
-        # Remove old requests outside time window
-        cutoff_time = current_time - self.time_window
-        while session_requests and session_requests[0] < cutoff_time:
-            session_requests.popleft()
+        session_requests = self._window(session_id, current_time)
+        if session_requests is None:
+            session_requests = self.request_history[session_id] = deque(maxlen=self.max_requests)
         
         # Check if under limit
         if len(session_requests) < self.max_requests:
@@ -37,10 +69,7 @@ class RateLimiter:
             return True, None
         
         # Calculate seconds until oldest request expires
-        oldest_request = session_requests[0]
-        seconds_until_reset = (oldest_request + self.time_window - current_time).total_seconds()
-        
-        return False, max(0, seconds_until_reset)
+        return False, max(0, session_requests[0] + self.time_window - current_time)
     
     def cleanup_expired_sessions(self, active_session_ids: set):
         """Remove rate limit data for expired sessions"""
@@ -49,34 +78,33 @@ class RateLimiter:
             del self.request_history[session_id]
         
         if expired_sessions:
-            logger.info(f"Cleaned up rate limit data for {len(expired_sessions)} expired sessions")
+            logger.info("Cleaned up rate limit data for %s expired sessions", len(expired_sessions))
     
-    def get_session_stats(self, session_id: str) -> Dict:
+    async def get_session_stats(self, session_id: str) -> Dict:
         """Get rate limit stats for a session"""
-        if session_id not in self.request_history:
+        if self.redis is not None:
+            key = self._redis_key(session_id)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                count, ttl_ms = await pipe.get(key).pttl(key).execute()
+            count = int(count or 0)
+            return {
+                "requests_in_window": count,
+                "requests_remaining": max(0, self.max_requests - count),
+                "window_reset_seconds": max(0, ttl_ms) / 1000 if count else 0
+            }
+
+        current_time = time.monotonic()
+        session_requests = self._window(session_id, current_time)
+        if not session_requests:
             return {
                 "requests_in_window": 0,
                 "requests_remaining": self.max_requests,
                 "window_reset_seconds": 0
             }
         
-        current_time = datetime.now()
-        session_requests = self.request_history[session_id]
-        cutoff_time = current_time - self.time_window
-        
-        # Удаление старых запросов вне временного окна
-        valid_requests = [req for req in session_requests if req >= cutoff_time]
-        requests_remaining = max(0, self.max_requests - len(valid_requests))
-        
-        # Вычисление до времени сброса
-        window_reset_seconds = 0
-        if valid_requests:
-            oldest_valid = min(valid_requests)
-            window_reset_seconds = (oldest_valid + self.time_window - current_time).total_seconds()
-            window_reset_seconds = max(0, window_reset_seconds)
-        
+        # Буфер упорядочен по времени — самый старый запрос в начале
         return {
-            "requests_in_window": len(valid_requests),
-            "requests_remaining": requests_remaining,
-            "window_reset_seconds": window_reset_seconds
+            "requests_in_window": len(session_requests),
+            "requests_remaining": max(0, self.max_requests - len(session_requests)),
+            "window_reset_seconds": max(0, session_requests[0] + self.time_window - current_time)
         }
\ No newline at end of file
@@ -0,0 +1,104 @@
+# src/rag_chatbot/core/search_batcher.py
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Tuple
+
+import numpy as np
+
+from src.rag_chatbot.utils.logger import logger
+
+class SearchBatcher:
+    """Объединение одновременных поисков FAISS в один батчевый index.search"""
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 10):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.running = False
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def start(self):
+        """Запуск фонового потока, собирающего запросы в батчи"""
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        logger.info("FAISS search batcher started")
+
+    def stop(self):
+        """Остановка потока; уже поставленные в очередь запросы будут выполнены"""
+        with self._lock:
+            if not self.running:
+                return
+            self.running = False
+            self._queue.put(None)
+        self._worker.join(timeout=5)
+        logger.info("FAISS search batcher stopped")
+
+    def search(self, index, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Поиск k ближайших соседей для каждой строки vectors.
+        Блокирует вызывающий поток, пока батч с этим запросом не будет выполнен.
+        Returns: (scores, indices) — как у index.search
+        """
+        vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+        future = Future()
+        with self._lock:
+            if not self.running:
+                # Батчер не запущен (например, скрипт вне FastAPI) — обычный поиск
+                return index.search(vectors, k)
+            self._queue.put((index, vectors, k, future))
+        return future.result()
+
+    def _run(self):
+        """Цикл потока: ждать первый запрос, добирать остальные до max_batch_size или max_wait"""
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            rows = len(item[1])
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                rows += len(item[1])
+
+            # Один вызов search на каждую пару (индекс, k)
+            groups = {}
+            for item in batch:
+                groups.setdefault((id(item[0]), item[2]), []).append(item)
+            for items in groups.values():
+                self._search_group(items)
+
+    def _search_group(self, items):
+        index, k = items[0][0], items[0][2]
+        try:
+            scores, indices = index.search(np.vstack([item[1] for item in items]), k)
+        except Exception as e:
+            logger.error("Batched FAISS search failed: %s", e)
+            for item in items:
+                item[3].set_exception(e)
+            return
+
+        offset = 0
+        for _, vectors, _, future in items:
+            n = len(vectors)
+            future.set_result((scores[offset:offset + n], indices[offset:offset + n]))
+            offset += n
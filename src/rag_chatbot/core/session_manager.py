@@ -1,83 +1,282 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 from datetime import datetime, timedelta
-from langchain.memory import ConversationBufferWindowMemory
-import uuid
+from collections import deque
+from itertools import islice
+from cachetools import TTLCache
+import threading
+import json
+import secrets
+import tiktoken
 from src.rag_chatbot.utils.logger import logger
 
+# Префиксы строк истории: в таком виде история попадает в промпт
+USER_PREFIX = "User: "
+AI_PREFIX = "Zaure: "
+
+# Токенизатор загружается один раз; каждое сообщение токенизируется только при добавлении в историю
+_encoding = tiktoken.encoding_for_model("gpt-4o")
+
+def count_tokens(text: str) -> int:
+    return len(_encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Начало текста не длиннее max_tokens токенов"""
+    return _encoding.decode(_encoding.encode(text, disallowed_special=())[:max_tokens])
+
+class ShardedTTLCache:
+    """TTLCache, разбитый на шарды по hash(key), у каждого шарда свой lock.
+    TTLCache не потокобезопасен, а сессии могут читаться и из пула потоков — шарды уменьшают конкуренцию за lock"""
+
+    def __init__(self, maxsize: int, ttl: float, shards: int = 16):
+        per_shard = max(1, -(-maxsize // shards))
+        self._shards: List[TTLCache] = [TTLCache(maxsize=per_shard, ttl=ttl) for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _index(self, key: str) -> int:
+        return hash(key) % len(self._shards)
+
+    def get(self, key: str, default=None):
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i].get(key, default)
+
+    def refresh(self, key: str):
+        """Получение значения с продлением TTL (повторная вставка) под одним lock"""
+        i = self._index(key)
+        with self._locks[i]:
+            shard = self._shards[i]
+            value = shard.get(key)
+            if value is not None:
+                shard[key] = value
+            return value
+
+    def __setitem__(self, key: str, value):
+        i = self._index(key)
+        with self._locks[i]:
+            self._shards[i][key] = value
+
+    def pop(self, key: str, default=None):
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i].pop(key, default)
+
+    def __len__(self) -> int:
+        total = 0
+        for shard, lock in zip(self._shards, self._locks):
+            # len() у TTLCache обходит список истечения, который меняют другие потоки, — тоже под lock шарда
+            with lock:
+                total += len(shard)
+        return total
+
+    def keys(self) -> List[str]:
+        keys = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                # Истекшие сессии удаляются здесь же (обычно их уже вытеснила запись в шард)
+                shard.expire()
+                keys.extend(shard.keys())
+        return keys
+
+    def items(self) -> List[tuple]:
+        items = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                items.extend(shard.items())
+        return items
+
 class SessionManager:
     """Чат сессии и память разговора"""
-    
-    def __init__(self, session_timeout_minutes: int = 30, max_memory_length: int = 10):
-        self.sessions: Dict[str, Dict] = {}
+
+    def __init__(self, session_timeout_minutes: int = 30, max_memory_length: int = 10,
+                 max_sessions: int = 10000, redis_url: str = "", shards: int = 16,
+                 context_token_budget: int = 800):
         self.session_timeout = timedelta(minutes=session_timeout_minutes)
         self.max_memory_length = max_memory_length
-    
-    def create_session(self) -> str:
+        self.context_token_budget = context_token_budget
+        # Ограниченный кэш сессий: истекшие по TTL и самые старые (LRU) сессии вытесняются автоматически
+        self.sessions = ShardedTTLCache(
+            maxsize=max_sessions,
+            ttl=self.session_timeout.total_seconds(),
+            shards=shards
+        )
+        # Последняя собранная статистика; пересобирается только после изменений сессий
+        self._stats_cache: Optional[Dict] = None
+        self._stats_dirty = True
+        # Redis — общее хранилище сессий для нескольких воркеров uvicorn
+        self.redis = None
+        if redis_url:
+            from redis.asyncio import Redis
+            self.redis = Redis.from_url(redis_url, decode_responses=True)
+
+    @staticmethod
+    def _redis_key(session_id: str) -> str:
+        return f"session:{session_id}"
+
+    def _new_history(self) -> deque:
+        # Кольцевой буфер уже отформатированных строк "User: ..."/"Zaure: ...":
+        # последние max_memory_length обменов, старые вытесняются сами
+        return deque(maxlen=self.max_memory_length * 2)
+
+    def _new_token_counts(self, history=()) -> deque:
+        # Кол-во токенов каждой строки истории — параллельный буфер той же длины
+        return deque((count_tokens(line) for line in history), maxlen=self.max_memory_length * 2)
+
+    def touch(self, session: Dict, now: Optional[datetime] = None):
+        """Обновление времени последнего доступа (строка ISO хранится сразу, чтобы не форматировать в статистике)"""
+        now = now or datetime.now()
+        session["last_accessed"] = now
+        session["last_accessed_iso"] = now.isoformat()
+        self._stats_dirty = True
+
+    def _serialize(self, session: Dict) -> str:
+        """Сессия -> JSON для Redis (только последние k обменов памяти)"""
+        return json.dumps({
+            "history": list(session["history"]),
+            "token_counts": list(session["token_counts"]),
+            "created_at": session["created_at_iso"],
+            "message_count": session["message_count"]
+        }, ensure_ascii=False)
+
+    def _deserialize(self, raw: str) -> Dict:
+        """JSON из Redis -> сессия"""
+        data = json.loads(raw)
+        history = self._new_history()
+        if "history" in data:
+            history.extend(data["history"])
+        else:
+            # Формат до перехода на строки: [{"role", "content"}]
+            history.extend(
+                (USER_PREFIX if msg["role"] == "human" else AI_PREFIX) + msg["content"]
+                for msg in data["messages"]
+            )
+        if len(data.get("token_counts", ())) == len(history):
+            token_counts = deque(data["token_counts"], maxlen=history.maxlen)
+        else:
+            token_counts = self._new_token_counts(history)
+        session = {
+            "history": history,
+            "token_counts": token_counts,
+            "created_at": datetime.fromisoformat(data["created_at"]),
+            "created_at_iso": data["created_at"],
+            "message_count": data["message_count"]
+        }
+        self.touch(session)
+        return session
+
+    async def create_session(self) -> str:
         """Create a new chat session"""
-        session_id = str(uuid.uuid4())
-        self.sessions[session_id] = {
-            "memory": ConversationBufferWindowMemory(
-                k=self.max_memory_length,
-                return_messages=True
-            ),
-            "created_at": datetime.now(),
-            "last_accessed": datetime.now(),
+        # 128 бит случайности, как у uuid4, но сразу URL-safe строка из 22 символов
+        session_id = secrets.token_urlsafe(16)
+        now = datetime.now()
+        session = {
+            "history": self._new_history(),
+            "token_counts": self._new_token_counts(),
+            "created_at": now,
+            "created_at_iso": now.isoformat(),
             "message_count": 0
         }
-        logger.info(f"Created new session: {session_id}")
+        self.touch(session, now)
+        self.sessions[session_id] = session
+        if self.redis is not None:
+            await self.redis.setex(
+                self._redis_key(session_id),
+                self.session_timeout,
+                self._serialize(session)
+            )
+        logger.info("Created new session: %s", session_id)
         return session_id
-    
-    def get_session(self, session_id: str) -> Optional[Dict]:
+
+    async def get_session(self, session_id: str) -> Optional[Dict]:
         """Получение сессии по ID"""
-        if session_id not in self.sessions:
-            return None
-        
-        session = self.sessions[session_id]
-        # Проверка если сессия уже истекла
-        if datetime.now() - session["last_accessed"] > self.session_timeout:
-            self.delete_session(session_id)
+        if self.redis is not None:
+            # Получение и продление TTL за один запрос
+            raw = await self.redis.getex(self._redis_key(session_id), ex=self.session_timeout)
+            if raw is None:
+                self.sessions.pop(session_id, None)
+                return None
+            session = self._deserialize(raw)
+            self.sessions[session_id] = session
+            return session
+
+        # Истекшие сессии TTLCache уже не возвращает; при попадании TTL продлевается повторной записью
+        session = self.sessions.refresh(session_id)
+        if session is None:
             return None
-        
-        # Обновление времени последнего доступа сессии
-        session["last_accessed"] = datetime.now()
+
+        # Обновление времени последнего доступа сессии (для статистики)
+        self.touch(session)
         return session
-    
-    def delete_session(self, session_id: str) -> bool:
+
+    def add_exchange(self, session: Dict, user_message: str, ai_message: str):
+        """Добавление обмена сообщениями в историю (строки сразу в формате промпта)"""
+        for line in (USER_PREFIX + user_message, AI_PREFIX + ai_message):
+            session["history"].append(line)
+            session["token_counts"].append(count_tokens(line))
+
+    def get_context_lines(self, session: Dict) -> List[str]:
+        """Последние строки истории — контекст разговора, который агент получает в промпт:
+        не больше max_memory_length строк и context_token_budget токенов (0 — без ограничения по токенам).
+        Последняя строка входит всегда, если она длиннее бюджета — обрезается до него"""
+        history = session["history"]
+        tokens = 0
+        lines = []
+        for line, n in islice(zip(reversed(history), reversed(session["token_counts"])), self.max_memory_length):
+            tokens += n
+            if self.context_token_budget and tokens > self.context_token_budget:
+                if not lines:
+                    lines.append(truncate_tokens(line, self.context_token_budget))
+                break
+            lines.append(line)
+        lines.reverse()
+        return lines
+
+    async def save_session(self, session_id: str, session: Dict):
+        """Сохранение изменений сессии после ответа"""
+        self.sessions[session_id] = session
+        self._stats_dirty = True
+        if self.redis is not None:
+            await self.redis.setex(
+                self._redis_key(session_id),
+                self.session_timeout,
+                self._serialize(session)
+            )
+
+    async def delete_session(self, session_id: str) -> bool:
         """Удаление сессии"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
-            logger.info(f"Deleted session: {session_id}")
-            return True
-        return False
-    
+        deleted = self.sessions.pop(session_id, None) is not None
+        self._stats_dirty = True
+        if self.redis is not None:
+            deleted = bool(await self.redis.delete(self._redis_key(session_id))) or deleted
+        if deleted:
+            logger.info("Deleted session: %s", session_id)
+        return deleted
+
     def get_active_session_ids(self) -> set:
         """Получить ID всех активные сессий"""
         return set(self.sessions.keys())
-    
-    def cleanup_expired_sessions(self):
-        """Удаление истекших по времени сессий"""
-        current_time = datetime.now()
-        expired_sessions = [
-            sid for sid, session in self.sessions.items()
-            if current_time - session["last_accessed"] > self.session_timeout
-        ]
-        
-        for session_id in expired_sessions:
-            self.delete_session(session_id)
-        
-        if expired_sessions:
-            logger.info(f"Cleaned up {len(expired_sessions)} expired sessions")
-    
+
+    async def close(self):
+        """Закрытие соединений с Redis"""
+        if self.redis is not None:
+            await self.redis.aclose()
+
     def get_session_stats(self) -> Dict:
-        """Получение статистики по активным сессиям"""
-        return {
+        """Получение статистики по активным сессиям (кэшируется до следующего изменения сессий)"""
+        # Кол-во сессий тоже сверяется: TTLCache может вытеснить сессию без вызова методов менеджера
+        if (not self._stats_dirty and self._stats_cache is not None
+                and self._stats_cache["active_sessions"] == len(self.sessions)):
+            return self._stats_cache
+
+        self._stats_cache = {
             "active_sessions": len(self.sessions),
             "sessions": {
                 sid: {
-                    "created_at": session["created_at"].isoformat(),
-                    "last_accessed": session["last_accessed"].isoformat(),
+                    "created_at": session["created_at_iso"],
+                    "last_accessed": session["last_accessed_iso"],
                     "message_count": session["message_count"]
                 }
                 for sid, session in self.sessions.items()
             }
-        }
\ No newline at end of file
+        }
+        self._stats_dirty = False
+        return self._stats_cache
@@ -1,20 +1,24 @@
 from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import os
 from datetime import datetime
 
 from src.rag_chatbot.utils.background_tasks import periodic_cleanup
 from src.rag_chatbot.api.routes import chat, health, sessions
+from src.rag_chatbot.api.middleware.fast_health import FastHealthMiddleware
 from src.rag_chatbot.config.settings import settings
 from src.rag_chatbot.utils.logger import logger
 
 # Analytics imports
 from src.rag_chatbot.core.database import init_database, check_database_health
-from src.rag_chatbot.core.instances import analytics_task_manager
+from src.rag_chatbot.core.instances import analytics_task_manager, search_batcher
+from src.rag_chatbot.core.http_clients import close_http_clients
+from rag_pipeline import rrf
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -40,6 +44,18 @@ async def lifespan(app: FastAPI):
         periodic_cleanup(chat.session_manager, chat.rate_limiter)
     )
     
+    # Пул потоков для блокирующего RAG-пайплайна (эмбеддинги, FAISS, OpenAI), чтобы не блокировать event loop
+    app.state.executor = ThreadPoolExecutor(
+        max_workers=settings.rag_executor_workers or min(32, (os.cpu_count() or 1) * 4),
+        thread_name_prefix="rag"
+    )
+    
+    # Батчинг поисков FAISS из параллельных запросов
+    search_batcher.start()
+    
+    # Прогрев JIT для RRF (если установлена numba)
+    rrf.warmup()
+    
     # Аналитика и планировщик задач
     try:
         analytics_task_manager.start()
@@ -60,12 +76,18 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.error(f"Error stopping analytics task manager: {e}")
         
+        app.state.executor.shutdown(wait=False, cancel_futures=True)
+        search_batcher.stop()
+        
         cleanup_task.cancel()
         try:
             await cleanup_task
         except asyncio.CancelledError:
             pass
         
+        await chat.session_manager.close()
+        await close_http_clients()
+        
         logger.info("RAG Chatbot API shutdown completed")
 
 app = FastAPI(
@@ -73,6 +95,7 @@ app = FastAPI(
     description="AI-ассистент для объяснения приказов",
     version=settings.version,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,  # сериализация ответов через orjson вместо json.dumps
     docs_url="/docs",
     redoc_url="/redoc"
 )
@@ -86,6 +109,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Добавляется последним, т.е. выполняется первым: проверки /health не проходят через CORS и роутинг
+app.add_middleware(FastHealthMiddleware)
+
 # Добавление API рутеров
 app.include_router(chat.router, prefix="/api/v1/chat", tags=["chat"])
 app.include_router(health.router, prefix="/api/v1/health", tags=["health"])
@@ -995,10 +1021,14 @@ async def get_metrics():
 
 if __name__ == "__main__":
     import uvicorn
+    # uvloop + httptools вместо asyncio + h11; воркеры uvicorn принимают соединения на общем сокете
     uvicorn.run(
-        "main:app",
-        host=getattr(settings, 'host', '0.0.0.0'),
-        port=getattr(settings, 'port', 8000),
-        reload=getattr(settings, 'debug', False),
+        "src.rag_chatbot.main:app",
+        host=settings.host,
+        port=settings.port,
+        workers=1 if settings.debug else settings.workers,
+        loop="uvloop",
+        http="httptools",
+        reload=settings.debug,
         log_level="info"
     )
\ No newline at end of file
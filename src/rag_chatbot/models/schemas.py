@@ -1,13 +1,18 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Dict, List, Optional, Any
 
 # Pydantic модели для чатбота
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+
     message: str = Field(..., min_length=1, max_length=2000, description="User message")
     session_id: Optional[str] = Field(None, description="Session ID for conversation continuity")
     mode: str = Field("original", description="RAG mode: 'original' or generated")
 
 class ChatResponse(BaseModel):
+    # Собирается из внутренних данных через model_construct, без повторной валидации
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+
     response: str
     session_id: str
     message_count: int
@@ -7,7 +7,7 @@ async def periodic_cleanup(session_manager: SessionManager, rate_limiter: RateLi
     while True:
         try:
             await asyncio.sleep(300)  # очищать каждые 5 минут
-            session_manager.cleanup_expired_sessions()
+            # Сессии истекают сами (TTLCache), чистятся только данные rate limiter
             active_sessions = session_manager.get_active_session_ids()
             rate_limiter.cleanup_expired_sessions(active_sessions)
         except asyncio.CancelledError:
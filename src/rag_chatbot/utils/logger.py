@@ -1,4 +1,5 @@
 import logging
+from src.rag_chatbot.config.settings import settings
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=settings.log_level.upper())
 logger = logging.getLogger(__name__)
\ No newline at end of file